@@ -8,8 +8,13 @@ Date: 02/04/2014
 """
 import sys, os
 import glob
+import hashlib
+import threading
 import subprocess as subp
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import numpy as np
 
 def createPath(path):
@@ -17,68 +22,655 @@ def createPath(path):
         os.mkdir(path)
 
 def get_rdcs(name):
-    filein = open(name, 'r')
-    rdcs = []
-    for line in filein:
-        line = line.split()
-        try: int(line[0])
-        except ValueError: continue
-        except IndexError: continue
-        rdcs.append(float(line[8]))
-    return np.asarray(rdcs)
+    """
+    Read a pales output file at once and return its couplings and RDCs.
+    The couplings (RESID_I ATOMNAME_I RESID_J ATOMNAME_J of each row) are
+    returned as a single string, to check that all the files match, and the
+    RDCs (column 9, D) are converted to floats in one vectorized call.
+    """
+    with open(name, 'r') as filein:
+        text = filein.read()
+    start = text.rfind('\nFORMAT')
+    vars_start = text.rfind('VARS', 0, start)
+    if start < 0 or vars_start < 0:
+        raise ValueError("No DATA block in %s" % name)
+    ncols = len(text[vars_start:text.index('\n', vars_start)].split()) - 1
+    table = np.array(text[text.index('\n', start+1):].split())
+    if table.size % ncols:
+        raise ValueError("Incomplete DATA block in %s" % name)
+    table = table.reshape(-1, ncols)
+    couplings = ' '.join(table[:, [0, 2, 3, 5]].ravel())
+    return couplings, table[:, 8].astype(float)
+
+def get_rdcs_safe(name):
+    """
+    get_rdcs, returning None if the file cannot be read
+    """
+    try:
+        return get_rdcs(name)
+    except (OSError, ValueError):
+        return None
+
+def parse_files(names, jobs=1):
+    """
+    yield get_rdcs(name) for each name, in order, parsing in jobs processes.
+    Unreadable files give None.
+    """
+    if jobs <= 1:
+        for name in names:
+            yield get_rdcs_safe(name)
+        return
+    # fork: the workers must not re-run this script
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+        for result in pool.map(get_rdcs_safe, names, chunksize=64):
+            yield result
 
 def generate_rdcs_files(pales_path, initial_structure, initial_dipolar_coupling, dipolar_coupling_output, H):
-    fileout = open("/dev/null", 'w')
-    if args.H:
-        pales_call = '%s -pdb %s -inD %s -outD %s.rdcs -H' % (pales_path, initial_structure, initial_dipolar_coupling, dipolar_coupling_output)
-    else:
-        pales_call = '%s -pdb %s -inD %s -outD %s.rdcs' % (pales_path, initial_structure, initial_dipolar_coupling, dipolar_coupling_output)
+    """
+    Call pales for one structure. Return True if it succeeded.
+    """
+    pales_call = '%s -pdb %s -inD %s -outD %s.rdcs' % (pales_path, initial_structure, initial_dipolar_coupling, dipolar_coupling_output)
+    if H:
+        pales_call += ' -H'
     pales_call_list = pales_call.split()
-    out = subp.call(pales_call_list, stdout = fileout, stderr=subp.STDOUT)
-    if out != 0:
-        print("\nCould not locate executable pales or error executing the following pales call:")
-        print(pales_call)
-        sys.exit()
+    try:
+        out = subp.call(pales_call_list, stdout=subp.DEVNULL, stderr=subp.STDOUT)
+    except OSError:
+        out = -1
+    return out == 0
+
+def run_pales(pales_path, filename, inD, outdirectory, H, retries=1):
+    """
+    Calculate and read the RDCs of one PDB, writing the pales output straight
+    to outdirectory. Failed calls are retried. Return the couplings and RDCs
+    (see get_rdcs), or None on failure.
+    """
+    output = os.path.join(outdirectory, os.path.basename(filename)[:-4])
+    for attempt in range(retries+1):
+        if generate_rdcs_files(pales_path, filename, inD, output, H):
+            result = get_rdcs_safe(output+'.rdcs')
+            if result is not None: return result
+    return None
+
+def file_hash(name):
+    """
+    Return the sha1 hex digest of the content of a file.
+    """
+    sha = hashlib.sha1()
+    with open(name, 'rb') as filein:
+        for block in iter(lambda: filein.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class RdcCache:
+    """
+    Persistent cache of pales RDC vectors in a directory.
+    The key combines the content of the PDB, the content of the inD file and
+    the -H flag, so renamed or copied structures are also found.
+    """
+    def __init__(self, directory, inD, H):
+        createPath(directory)
+        self.directory = directory
+        self.salt = file_hash(inD) + ('-H' if H else '')
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, pdb):
+        key = hashlib.sha1((file_hash(pdb) + self.salt).encode()).hexdigest()
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, pdb, calc):
+        """
+        Return the cached couplings and RDCs of pdb, or calc(pdb) stored in the cache.
+        """
+        path = self.path(pdb)
+        try:
+            with np.load(path) as data:
+                result = str(data['couplings']), data['rdcs']
+            os.utime(path) # recently used files are evicted last
+            with self.lock: self.hits += 1
+            return result
+        except (OSError, ValueError, KeyError):
+            pass
+        with self.lock: self.misses += 1
+        result = calc(pdb)
+        if result is not None:
+            tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+            with open(tmp, 'wb') as fileout:
+                np.savez(fileout, couplings=result[0], rdcs=result[1])
+            os.replace(tmp, path)
+        return result
+
+    def evict(self, max_bytes):
+        """
+        Remove the least recently used entries until the cache is below max_bytes.
+        Return the number of removed entries.
+        """
+        entries = []
+        for name in glob.glob(os.path.join(self.directory, '*.npz')):
+            st = os.stat(name)
+            entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, name in entries:
+            if total <= max_bytes: break
+            os.remove(name)
+            total -= size
+            removed += 1
+        return removed
+
+# Native RDC calculation, an in-process alternative to pales
+
+# Gyromagnetic ratios (rad s^-1 T^-1) by element
+GAMMA = {'H': 267.5222e6, 'C': 67.2828e6, 'N': -27.116e6, 'P': 108.291e6, 'F': 251.815e6}
+
+def read_inD(name):
+    """
+    Read the couplings of a pales dipolar coupling input file.
+    Return the couplings string (as in get_rdcs), the (residue, atom) pairs of
+    each coupling and the experimental D values.
+    """
+    with open(name, 'r') as filein:
+        text = filein.read()
+    start = text.rfind('\nFORMAT')
+    vars_start = text.rfind('VARS', 0, start)
+    if start < 0 or vars_start < 0:
+        raise ValueError("No DATA block in %s" % name)
+    names = text[vars_start:text.index('\n', vars_start)].split()[1:]
+    table = np.array(text[text.index('\n', start+1):].split()).reshape(-1, len(names))
+    columns = [names.index(var) for var in ('RESID_I', 'ATOMNAME_I', 'RESID_J', 'ATOMNAME_J')]
+    couplings = ' '.join(table[:, columns].ravel())
+    pairs = [((int(ri), ai), (int(rj), aj)) for ri, ai, rj, aj in table[:, columns]]
+    return couplings, pairs, table[:, names.index('D')].astype(float)
+
+def read_pdb(name):
+    """
+    Return the (residue, atom name) keys and the coordinates of the atoms of the
+    first model of a PDB file.
+    """
+    keys, coords = [], []
+    with open(name, 'r') as filein:
+        for line in filein:
+            if line.startswith(('ATOM', 'HETATM')):
+                keys.append((int(line[22:26]), line[12:16].strip()))
+                coords.append(line[30:54])
+            elif line.startswith('ENDMDL'):
+                break
+    coords = np.array(' '.join(coords).split(), dtype=float).reshape(-1, 3)
+    return keys, coords
+
+def atom_index(keys, pairs):
+    """
+    Return the indices in keys of the two atoms of each coupling.
+    The amide proton is found both as HN (pales) and H (most PDB files).
+    """
+    index = {key: i for i, key in enumerate(keys)}
+    alias = {'HN': 'H', 'H': 'HN'}
+    def find(key):
+        if key in index: return index[key]
+        return index[(key[0], alias.get(key[1], key[1]))]
+    return (np.array([find(p[0]) for p in pairs]), np.array([find(p[1]) for p in pairs]))
+
+def dmax(pairs, vectors):
+    """
+    Return the dipolar coupling constants (Hz) of the couplings for internuclear
+    vectors (..., M, 3) in Angstrom: -mu0/(4 pi) gamma_i gamma_j h / (2 pi^2 r^3)
+    """
+    gg = np.array([GAMMA[p[0][1][0]]*GAMMA[p[1][1][0]] for p in pairs])
+    r = np.sqrt(np.einsum('...i,...i->...', vectors, vectors))*1e-10
+    return -1e-7*gg*6.62607e-34/(2*np.pi**2*r**3)
+
+def sphere(n=400):
+    """
+    Return n directions evenly spread on the unit sphere (Fibonacci lattice).
+    """
+    z = 1 - (2*np.arange(n) + 1)/n
+    phi = np.pi*(3 - np.sqrt(5))*np.arange(n)
+    r = np.sqrt(1 - z*z)
+    return np.c_[r*np.cos(phi), r*np.sin(phi), z]
+
+def p2_basis(u):
+    """
+    Return the five independent components of the traceless order matrix
+    contracted with unit vectors u (..., 3): D = Dmax * basis . s
+    """
+    x, y, z = u[..., 0], u[..., 1], u[..., 2]
+    return np.stack([y*y - x*x, z*z - x*x, 2*x*y, 2*x*z, 2*y*z], axis=-1)
+
+def steric_order(coords, wv=0.05, directions=None):
+    """
+    Return the order matrices (B,3,3) of structures coords (B,A,3) with a steric
+    obstruction model: between two planar walls 40/wv Angstrom apart, each
+    orientation of the wall normal is allowed for the positions of the center
+    that keep every atom between the walls, the distance minus the extent of
+    the structure along the normal. The walls are bicelles, whose normal is
+    perpendicular to the field. The average over the orientations of the
+    directions agrees with a Monte Carlo simulation of the same model
+    (tests/test_runpales.py). It has not been validated against pales.
+    """
+    if directions is None: directions = sphere()
+    proj = np.einsum('bad,kd->bak', coords, directions)
+    allowed = np.clip(40./wv - (proj.max(1) - proj.min(1)), 0, None)
+    p2 = 1.5*directions[:, :, None]*directions[:, None, :] - 0.5*np.eye(3)
+    # Wall normal perpendicular to the field: P2 of the field is -1/2 P2 of the normal
+    return -0.5*np.einsum('bk,kij->bij', allowed, p2)/allowed.sum(1)[:, None, None]
+
+def native_rdcs(coords, index, pairs, backend='steric', D=None, wv=0.05):
+    """
+    Calculate the RDCs of a batch of structures with the same atoms, coords (B,A,3).
+    backend 'steric' predicts the alignment from the shape of each structure,
+    'svd' fits the alignment tensor of each structure to the experimental D values.
+    Return an array (B,M).
+    """
+    vectors = coords[:, index[1]] - coords[:, index[0]]
+    constants = dmax(pairs, vectors)
+    basis = p2_basis(vectors/np.linalg.norm(vectors, axis=-1)[..., None])*constants[..., None]
+    if backend == 'svd':
+        s = np.einsum('bkm,m->bk', np.linalg.pinv(basis), D)
+    else:
+        order = steric_order(coords - coords.mean(1)[:, None], wv)
+        s = np.stack([order[:, 1, 1], order[:, 2, 2], order[:, 0, 1], order[:, 0, 2], order[:, 1, 2]], axis=-1)
+    return np.einsum('bmk,bk->bm', basis, s)
+
+def native_batch(filenames, inD, backend='steric', wv=0.05):
+    """
+    Read a batch of PDB files and calculate their RDCs together.
+    Return a list with the couplings and RDCs of each file (None on failure).
+    """
+    couplings, pairs, D = inD
+    results = [None]*len(filenames)
+    groups = {}
+    for i, filename in enumerate(filenames):
+        try:
+            keys, coords = read_pdb(filename)
+            index = atom_index(keys, pairs)
+        except (OSError, ValueError, KeyError):
+            continue
+        groups.setdefault(tuple(keys), (index, []))[1].append((i, coords))
+    for index, members in groups.values():
+        rdcs = native_rdcs(np.array([c for i, c in members]), index, pairs, backend, D, wv)
+        for (i, c), row in zip(members, rdcs):
+            results[i] = couplings, row
+    return results
+
+# Trajectories: the frames of a multi-model PDB or of a trajectory with a
+# topology PDB are read one by one, instead of a directory of PDBs
 
-parser = argparse.ArgumentParser(description="Extract RDC values from .pdb files using the PALES program.")
-parser.add_argument('--path', '-p', help ="The path to the pales executable is.", required=True)
-parser.add_argument('indirectory', help ="The directory where the pdbs are.")
-parser.add_argument('--outdirectory', '-outD', \
-  help ="The directory where the RDCs outfiles are going to be. (Default is indirectory)")
-parser.add_argument('--outarray', '-outA', default='rdcs.npy',\
-  help ="The name of the file containing the array of RDCs. (Default is rdcs.npy)")
-parser.add_argument('--inD',  \
-        help ="Dipolar Coupling input file. Determine which rdcs to calculate (see Pales odcumpentation).", \
-        required=True)
-parser.add_argument('-H', action='store_true', help ="Use -H option in Pales (see Pales documentation).")
+def pdb_atoms(name):
+    """
+    Return the ATOM and HETATM lines of the first model of a PDB file.
+    """
+    lines = []
+    with open(name, 'r') as filein:
+        for line in filein:
+            if line.startswith(('ATOM', 'HETATM')):
+                lines.append(line.rstrip('\n'))
+            elif line.startswith('ENDMDL'):
+                break
+    return lines
 
-args = parser.parse_args()
+def write_pdb(name, lines, coords):
+    """
+    Write a PDB file with the atoms of lines placed at coords.
+    """
+    with open(name, 'w') as fileout:
+        for line, (x, y, z) in zip(lines, coords):
+            fileout.write('%s%8.3f%8.3f%8.3f%s\n' % (line[:30], x, y, z, line[54:]))
+        fileout.write('END\n')
 
-#Checking the Initial options
+def pdb_frames(name):
+    """
+    yield the coordinates of each model of a multi-model PDB file.
+    """
+    coords = []
+    with open(name, 'r') as filein:
+        for line in filein:
+            if line.startswith(('ATOM', 'HETATM')):
+                coords.append(line[30:54])
+            elif line.startswith('ENDMDL') and coords:
+                yield np.array(' '.join(coords).split(), dtype=float).reshape(-1, 3)
+                coords = []
+    if coords:
+        yield np.array(' '.join(coords).split(), dtype=float).reshape(-1, 3)
 
-filelist_pdbs = glob.glob(args.indirectory +'/*.pdb')
-filelist_pdbs.sort()
+def dcd_header(filein):
+    """
+    Read the header of a CHARMM/NAMD DCD file.
+    Return the byte order, the number of atoms, whether frames have a unit cell
+    record and the offset of the first frame.
+    """
+    first = filein.read(4)
+    for order in ('<', '>'):
+        if np.frombuffer(first, dtype=order+'i4')[0] == 84: break
+    else:
+        raise ValueError("%s is not a DCD file" % filein.name)
+    header = np.frombuffer(filein.read(84), dtype=order+'i4')
+    if header[:1].view('S4')[0] != b'CORD':
+        raise ValueError("%s is not a DCD file" % filein.name)
+    icntrl = header[1:21]
+    if icntrl[8]:
+        raise ValueError("DCD files with fixed atoms are not supported")
+    filein.read(4)
+    # Title record
+    size = np.frombuffer(filein.read(4), dtype=order+'i4')[0]
+    filein.seek(size + 4, 1)
+    filein.read(4)
+    natoms = int(np.frombuffer(filein.read(4), dtype=order+'i4')[0])
+    filein.read(4)
+    return order, natoms, bool(icntrl[19] and icntrl[10]), filein.tell()
+
+def dcd_frames(name, start=0):
+    """
+    yield the coordinates of each frame of a DCD file, from frame start.
+    """
+    with open(name, 'rb') as filein:
+        order, natoms, cell, offset = dcd_header(filein)
+        record = 4*natoms + 8
+        framesize = 3*record + (56 if cell else 0)
+        filein.seek(offset + start*framesize)
+        dtype = np.dtype(order+'f4')
+        while True:
+            frame = filein.read(framesize)
+            if len(frame) < framesize: break
+            frame = frame[56:] if cell else frame
+            xyz = [np.frombuffer(frame, dtype=dtype, count=natoms, offset=i*record+4) for i in range(3)]
+            yield np.stack(xyz, axis=-1).astype(float)
+
+def count_frames(name, top=None):
+    """
+    Return the number of frames of a multi-model PDB or trajectory file.
+    """
+    if name.endswith('.pdb'):
+        with open(name, 'r') as filein:
+            models = sum(1 for line in filein if line.startswith('ENDMDL'))
+        return max(models, 1)
+    if name.endswith('.dcd'):
+        with open(name, 'rb') as filein:
+            order, natoms, cell, offset = dcd_header(filein)
+        return (os.path.getsize(name) - offset)//(3*(4*natoms + 8) + (56 if cell else 0))
+    try:
+        import mdtraj
+    except ImportError:
+        sys.exit("Reading %s needs mdtraj (pip install mdtraj)." % name)
+    with mdtraj.open(name) as trajectory:
+        return len(trajectory)
+
+def trajectory_frames(name, top=None, start=0):
+    """
+    yield the coordinates (Angstrom) of each frame of name, from frame start.
+    Multi-model PDB and DCD files are read directly; other formats (XTC, TRR...)
+    need mdtraj.
+    """
+    from itertools import islice
+    if name.endswith('.pdb'):
+        for coords in islice(pdb_frames(name), start, None):
+            yield coords
+    elif name.endswith('.dcd'):
+        for coords in dcd_frames(name, start):
+            yield coords
+    else:
+        try:
+            import mdtraj
+        except ImportError:
+            sys.exit("Reading %s needs mdtraj (pip install mdtraj)." % name)
+        for chunk in mdtraj.iterload(name, top=top, chunk=1000, skip=start):
+            for coords in chunk.xyz:
+                yield 10*coords.astype(float)
+
+def native_frames(frames, keys, inD, backend='steric', wv=0.05, batch=256):
+    """
+    yield the couplings and RDCs of each frame, calculated in batches.
+    """
+    from itertools import islice
+    couplings, pairs, D = inD
+    index = atom_index(keys, pairs)
+    while True:
+        coords = list(islice(frames, batch))
+        if not coords: return
+        for rdcs in native_rdcs(np.array(coords), index, pairs, backend, D, wv):
+            yield couplings, rdcs
 
-if args.outdirectory: createPath(args.outdirectory)
-else: args.outdirectory=args.indirectory
+def pales_frame(calc, lines, outdirectory, i, coords):
+    """
+    Write frame i to a temporary PDB file, calculate its RDCs with calc and
+    remove the temporary files.
+    """
+    name = os.path.join(outdirectory, 'frame%09d.pdb' % i)
+    write_pdb(name, lines, coords)
+    try:
+        return calc(name)
+    finally:
+        for tmp in (name, name[:-4]+'.rdcs'):
+            if os.path.exists(tmp): os.remove(tmp)
+
+def ordered_map(func, items, jobs=1):
+    """
+    yield func(item) for each item, in order, keeping up to jobs calls in flight.
+    Threads are enough: each call waits on a pales process.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= 2*jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def main():
+    """
+    Parse the command line and generate the RDCs of all the structures.
+    """
+    parser = argparse.ArgumentParser(description="Extract RDC values from .pdb files using the PALES program.")
+    parser.add_argument('--path', '-p', help ="The path to the pales executable is. (Required with the pales backend)")
+    parser.add_argument('indirectory', help ="The directory where the pdbs are, a multi-model PDB or a trajectory file.")
+    parser.add_argument('--outdirectory', '-outD', \
+      help ="The directory where the RDCs outfiles are going to be. (Default is indirectory)")
+    parser.add_argument('--outarray', '-outA', default='rdcs.npy',\
+      help ="The name of the file containing the array of RDCs. (Default is rdcs.npy)")
+    parser.add_argument('--inD',  \
+            help ="Dipolar Coupling input file. Determine which rdcs to calculate (see Pales odcumpentation).", \
+            required=True)
+    parser.add_argument('-H', action='store_true', help ="Use -H option in Pales (see Pales documentation).")
+    parser.add_argument('--jobs', '-j', type=int, default=1, \
+      help ="Number of pales processes run in parallel. (Default is 1)")
+    parser.add_argument('--retries', type=int, default=1, \
+      help ="Number of times a failed pales call is repeated before giving up on a structure. (Default is 1)")
+    parser.add_argument('--cache', \
+      help ="Directory of a persistent cache of RDCs. Pales is only called for structures not in the cache.")
+    parser.add_argument('--cache_size', type=float, default=1024., \
+      help ="Maximum size of the cache in MB. The least recently used entries are removed. (Default is 1024)")
+    parser.add_argument('--checkpoint', type=int, default=1000, \
+      help ="Number of structures between checkpoints of the output array. (Default is 1000)")
+    parser.add_argument('--resume', action='store_true', \
+      help ="Resume an interrupted run from its last checkpoint.")
+    parser.add_argument('--parse_only', action='store_true', \
+      help ="Do not call pales: build the array from the .rdcs files already in outdirectory, parsing them in --jobs processes.")
+    parser.add_argument('--backend', choices=['pales', 'steric', 'svd'], default='pales', \
+      help ="How RDCs are calculated: pales, or in process with an alignment tensor fitted to the D values of \
+    inD (svd). The svd RDCs are fitted to the experimental D values, so they must not be reweighted by MaxEnt \
+    against the same values (the fit would be circular). The steric alignment model (steric) has not been \
+    validated against pales yet and is only accepted with --check. (Default is pales)")
+    parser.add_argument('--wv', type=float, default=0.05, \
+      help ="Liquid crystal concentration (g/ml) of the steric backend. (Default is 0.05)")
+    parser.add_argument('--batch', type=int, default=256, \
+      help ="Number of structures calculated together by the steric and svd backends. (Default is 256)")
+    parser.add_argument('--check', type=int, default=0, \
+      help ="Compare the steric or svd backend with pales on the first CHECK structures and exit.")
+    parser.add_argument('--top', \
+      help ="Topology PDB of a trajectory. (Default is the first model of a multi-model PDB)")
+
+    args = parser.parse_args()
+    native = args.backend != 'pales'
+    if args.backend == 'steric' and not args.check:
+        parser.error("the steric backend has not been validated against pales: use it with --check only")
+    if (not native or args.check) and not args.parse_only and not args.path:
+        parser.error("--path is required with the pales backend")
+
+    #Checking the Initial options
+
+    trajectory = not os.path.isdir(args.indirectory)
+    if trajectory:
+        # The frames are read one by one; Processed_PDB.dat lists them as file:frame
+        topology = args.top or args.indirectory
+        if not topology.endswith('.pdb'):
+            parser.error("--top is required with a %s trajectory" % os.path.splitext(args.indirectory)[1])
+        if args.parse_only or args.check:
+            parser.error("--parse_only and --check need a directory of pdbs")
+        ntotal = count_frames(args.indirectory, topology)
+    else:
+        filelist_pdbs = glob.glob(args.indirectory +'/*.pdb')
+        filelist_pdbs.sort()
+        ntotal = len(filelist_pdbs)
 
-#Executing generate_rdc_files. Storing in a .dat file the name of all the processed PDBs in order.
+    if args.outdirectory: createPath(args.outdirectory)
+    elif trajectory: args.outdirectory = os.path.dirname(args.indirectory) or '.'
+    else: args.outdirectory=args.indirectory
+
+    #Executing generate_rdc_files. Storing in a .dat file the name of all the processed PDBs in order.
+    #The RDCs are written in place into a preallocated memory-mapped array, and a checkpoint
+    #file records how far the run got, so that an interrupted run can be resumed.
+
+    if not args.outarray.endswith('.npy'): args.outarray += '.npy'
+    processed_name = os.path.join(args.outdirectory, 'Processed_PDB.dat')
+    failed_name = os.path.join(args.outdirectory, 'Failed_PDB.dat')
+    checkpoint_name = args.outarray + '.ckpt'
+
+    # The checkpoint also records the structures of the run and the couplings of
+    # the rows already written, which a resumed run must share
+    listing = filelist_pdbs if not trajectory else ['%s:%d' % (args.indirectory, ntotal)]
+    listing = hashlib.sha1('\n'.join(listing).encode()).hexdigest()
+    start, nrows, nfailed = 0, 0, 0
+    rdcs_array = None
+    reference = None
+    if args.resume and os.path.exists(checkpoint_name):
+        with open(checkpoint_name) as checkpoint_file:
+            fields = checkpoint_file.readline().split()
+            reference = checkpoint_file.readline().rstrip('\n') or None
+        if len(fields) != 5 or int(fields[3]) != ntotal or fields[4] != listing:
+            sys.exit("The structures of %s are not those of the interrupted run: run again without --resume."
+                     % args.indirectory)
+        start, nrows, nfailed = [int(x) for x in fields[:3]]
+        if nrows:
+            rdcs_array = np.lib.format.open_memmap(args.outarray, mode='r+')
+        # Drop whatever was written after the checkpoint
+        for name, n in ((processed_name, nrows), (failed_name, nfailed)):
+            lines = open(name).readlines()[:n] if os.path.exists(name) else []
+            with open(name, 'w') as datfile:
+                datfile.writelines(lines)
+        print('Resuming at structure %i.' % (start+1))
+    writer = open(processed_name, mode='a' if start else 'w')
+    failed_writer = open(failed_name, mode='a' if start else 'w')
+
+    def checkpoint(next_file):
+        """
+        Flush the array and the lists of structures, then record the progress.
+        """
+        if rdcs_array is not None: rdcs_array.flush()
+        writer.flush()
+        failed_writer.flush()
+        with open(checkpoint_name + '.tmp', 'w') as checkpoint_file:
+            checkpoint_file.write('%d %d %d %d %s\n%s\n' % (next_file, nrows, nfailed, ntotal, listing,
+                                                           reference or ''))
+        os.replace(checkpoint_name + '.tmp', checkpoint_name)
+
+    print('Generating %i rdcs from %s in %s.'%(ntotal, args.indirectory, args.outdirectory))
+    calc = lambda filename: run_pales(args.path, filename, args.inD, args.outdirectory, args.H, args.retries)
+    if args.cache:
+        cache = RdcCache(args.cache, args.inD, args.H)
+        pales_calc = calc
+        calc = lambda filename: cache.get(filename, pales_calc)
+    if trajectory:
+        pending = ('%s:%d' % (args.indirectory, i) for i in range(start, ntotal))
+        frames = trajectory_frames(args.indirectory, topology, start)
+    else:
+        pending = filelist_pdbs[start:]
+    if native:
+        inD = read_inD(args.inD)
+    if args.check:
+        # Pearson correlation and least squares scale of the native RDCs against pales
+        check_files = filelist_pdbs[:args.check]
+        for filename, result, pales_result in zip(check_files, native_batch(check_files, inD, args.backend, args.wv),
+                ordered_map(lambda filename: run_pales(args.path, filename, args.inD, args.outdirectory, args.H), check_files, args.jobs)):
+            if result is None or pales_result is None or result[0] != pales_result[0]:
+                print("%s: failed or different couplings" % filename)
+                continue
+            rdcs, pales_rdcs = result[1], pales_result[1]
+            scale = np.dot(rdcs, pales_rdcs)/np.dot(rdcs, rdcs)
+            print("%s: r = %.4f, pales/native scale = %.4g" % (filename, np.corrcoef(rdcs, pales_rdcs)[0, 1], scale))
+            # MaxEnt rescales the RDCs by the absolute value of the scale, which hides a sign error
+            if scale < 0: print("%s: the native RDCs have the opposite sign of pales" % filename)
+        sys.exit()
+    if trajectory and native:
+        results = native_frames(frames, read_pdb(topology)[0], inD, args.backend, args.wv, args.batch)
+    elif trajectory:
+        lines = pdb_atoms(topology)
+        results = ordered_map(lambda frame: pales_frame(calc, lines, args.outdirectory, *frame),
+                              enumerate(frames, start), args.jobs)
+    elif native and not args.parse_only:
+        # No pales processes and no .rdcs files: batches of structures are calculated in process
+        results = (result for j in range(0, len(pending), args.batch)
+                   for result in native_batch(pending[j:j+args.batch], inD, args.backend, args.wv))
+    elif args.parse_only:
+        results = parse_files([os.path.join(args.outdirectory, os.path.basename(filename)[:-4]+'.rdcs')
+                               for filename in pending], args.jobs)
+    else:
+        results = ordered_map(calc, pending, args.jobs)
+    for i, (filename, result) in enumerate(zip(pending, results), start):
+        print("\rDoing structure %5d" %(i+1,), end="")
+        couplings, rdcs = result if result is not None else (None, None)
+        if rdcs is not None and rdcs_array is None:
+            # The first structure gives the number of RDCs
+            rdcs_array = np.lib.format.open_memmap(args.outarray, mode='w+',
+                            dtype=float, shape=(ntotal, len(rdcs)))
+        if rdcs is not None and reference is None:
+            reference = couplings
+        if rdcs is None or len(rdcs) != rdcs_array.shape[1] or couplings != reference:
+            failed_writer.write(filename+'\n')
+            nfailed += 1
+        else:
+            rdcs_array[nrows] = rdcs
+            nrows += 1
+            writer.write(filename+'\n')
+        if (i+1) % args.checkpoint == 0: checkpoint(i+1)
+
+    checkpoint(ntotal)
+    writer.close()
+    failed_writer.close()
+    print()
+
+    if nfailed:
+        print("\nCould not locate executable pales, error executing pales or couplings different from the first structure for %i structures." % nfailed)
+        print("They are listed in %s and are not included in the array." % failed_name)
+    else:
+        os.remove(failed_name)
 
-writer=open(args.outdirectory+'Processed_PDB.dat', mode='w')
-rdcs_array = []
+    if args.backend == 'svd':
+        print("The svd RDCs are fitted to the D values of %s: do not reweight them against these values." % args.inD)
 
-print('Generating %i rdcs from %s in %s.'%(len(filelist_pdbs), args.indirectory, args.outdirectory))
-for i, filename in enumerate(filelist_pdbs):
-    print("\rDoing structure %5d" %(i+1,), end="")
-    generate_rdcs_files(args.path, filename, args.inD, filename[:-4], args.H)
-    if args.outdirectory!=args.indirectory: subp.call(['mv', filename[:-4]+'.rdcs', args.outdirectory])
-    writer.write(filename+'\n')
-    # Get the RDCS for the file
-    rdcs_array.append(get_rdcs(filename))
-  
-writer.close()
-print()
+    if args.cache:
+        evicted = cache.evict(args.cache_size*2**20)
+        print("Cache: %i hits, %i misses, %i entries evicted." % (cache.hits, cache.misses, evicted))
 
-rdcs_array = np.asarray(rdcs_array)
-np.save(args.outarray, rdcs_array)
+    if rdcs_array is None:
+        np.save(args.outarray, np.zeros((0, 0)))
+    elif nrows < rdcs_array.shape[0]:
+        # Failed structures left unused rows at the end of the array
+        compact = np.lib.format.open_memmap(args.outarray + '.tmp', mode='w+',
+                        dtype=float, shape=(nrows, rdcs_array.shape[1]))
+        for j in range(0, nrows, 65536):
+            compact[j:j+65536] = rdcs_array[j:min(j+65536, nrows)]
+        compact.flush()
+        del compact, rdcs_array
+        os.replace(args.outarray + '.tmp', args.outarray)
+    os.remove(checkpoint_name)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+MaxEnt: Maximum Entropy re-weighting of ensembles of structures to fit
+experimental data.
+
+kernel - the log-sum-exp weights shared by all the fits (streamed, threaded)
+cs     - fit of data that are not rescaled, such as chemical shifts
+rdc    - fit of RDCs, rescaled to the experimental ones
+reduction - fit of redundant ensembles reduced to representatives
+validation - cross-validation of sigma2 over the observables
+resampling - bootstrap and jackknife errors of the fit
+incremental - refit of an ensemble that grows by appending structures
+sparse - sparse storage of the weights and refit on their support
+joint  - joint fit of several groups of observables (RDCs, chemical shifts...)
+io     - reading and writing the arrays
+cli    - the maxent command (python -m maxent)
+
+Author: Ramon Crehuet, Melchor Sanchez-Martinez
+"""
+
+from .io import load
+from .kernel import w, qave, n_eff
+from .cs import rmsd, fit, fit_path, fit_many
+from . import cs, rdc, joint, reduction, validation, resampling, sparse, incremental
@@ -0,0 +1,406 @@
+"""
+The maxent command: Maximum Entropy fit of ensemble data to experimental data.
+
+    maxent rdc  - RDCs, rescaled to fit the experimental ones (factq)
+    maxent cs   - chemical shifts or other data that are not rescaled
+    maxent joint - several groups of observables with a single set of weights
+    maxent cv   - cross-validation of sigma2 over the observables
+    maxent resample - bootstrap or jackknife errors of the fit
+"""
+
+import sys
+import argparse
+import numpy as np
+
+from . import cs, rdc, joint, reduction, validation, resampling, sparse
+from .io import load, save, load_experimental, residues
+from .kernel import Columns, w, qave
+
+
+def _parser():
+    """
+    return the parser of the maxent command and its subcommands
+    """
+    data = argparse.ArgumentParser(add_help=False)
+    data.add_argument("calculated", help="Data for each structure. A numpy array or a text file of shape (M,N).")
+    data.add_argument("experimental", help = "Experimental data. A numpy array or a text file of shape (2,N), where the first column is the residue number and the second its data value")
+    data.add_argument("--initial_residue", "-i", help = "Initial residue to fit", type=int)
+    data.add_argument("--final_residue", "-f", help = "Final residue to fit", type=int)
+    data.add_argument("--dtype", choices=['float64', 'float32'], \
+       help="Precision of the calculated data. With float32 they take half the memory and the products are done in single precision, summed in double precision. Default that of the file")
+
+    common = argparse.ArgumentParser(add_help=False, parents=[data])
+    common.add_argument("--save", "-s", \
+        help="Save the Optimized data in text or numpy format (according to extension)")
+    common.add_argument("--save_weights", "-sw", \
+       help="Save the Optimized weights in text or numpy (npy) format (according to extension).")
+    common.add_argument("--save_image", "-si",  \
+       help="Save an image of the Optimized data together with the initial data sets and the optimized weights")
+    common.add_argument("--no-plot", "-np", action='store_true', \
+       help="Batch mode: do not plot nor wait for input. matplotlib is only loaded to save the image of --save_image")
+    common.add_argument("--sparse", type=float, metavar='MASS', \
+       help="Keep only the structures holding a fraction MASS (e.g. 0.99) of the weight: --save_weights writes their indices and weights to a .npz file and only they are plotted")
+    common.add_argument("--top", type=int, default=0, help="Print the TOP structures with the largest weights")
+    common.add_argument("--names", help="File with the name of each structure, one per line (Processed_PDB.dat of RunPales), saved with the sparse weights and printed with --top")
+
+    parser = argparse.ArgumentParser(prog='maxent', description="Maximum Entropy fit of ensemble data to experimental data")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    prdc = commands.add_parser('rdc', parents=[common], help="Fit RDCs, rescaled to the experimental ones",
+                               description="Maximum Entropy fit of ensemble RDCs to experimental RDCs")
+    prdc.add_argument("--error", choices=['sigma', 'threshold'], default='sigma', \
+       help="Error model: gaussian error of the experimental RDCs (sigma) or a threshold of the rmsd below which the fit is not improved. Default sigma")
+    prdc.add_argument("--sigma2", type=float, default=1.0, \
+       help="Variance of the experimental error, or threshold with --error threshold. Default 1")
+    prdc.add_argument("--k", type=float, default=1e7, help="Initial regularization constant. Default 1e7")
+    prdc.set_defaults(run=run_rdc)
+
+    pcs = commands.add_parser('cs', parents=[common], help="Fit chemical shifts or other data that are not rescaled",
+                              description="Maximum Entropy fit of ensemble data to experimental data")
+    pcs.add_argument("--sigma2", help = "Variance of the gaussian error model, a number or a numpy array file. Default 0 (no error model)", default=0.0)
+    pcs.add_argument("--method", default='BFGS', help="scipy.optimize.minimize method. Default BFGS")
+    pcs.add_argument("--chunksize", type=int, help="Rows of the calculated data per block. Default all, or blocks of 65536 rows for .npy files")
+    pcs.add_argument("--jobs", "-j", type=int, help="Number of threads evaluating blocks of the calculated data. Default 1")
+    pcs.add_argument("--prior", help="Prior weights of the structures (e.g. from enhanced sampling or cluster sizes), a numpy array or a text file of shape (M,). Default uniform")
+    pcs.add_argument("--plot_errors", action='store_true', help="Plot the errors instead of the data")
+    pcs.add_argument("--reduce", type=float, metavar='TOL', help="Fit representatives of the structures whose data round to the same point of a grid of spacing TOL (0 for identical structures), weighted by their multiplicity")
+    pcs.add_argument("--refit_support", action='store_true', help="Fit again on the structures kept by --sparse only")
+    pcs.add_argument("--clusters", type=int, help="Fit representatives of CLUSTERS k-means clusters of the structures, weighted by their size")
+    pcs.set_defaults(run=run_cs)
+
+    pjoint = commands.add_parser('joint', parents=[common], help="Fit several groups of observables together",
+                                 description="Maximum Entropy fit of several groups of observables with a single set of weights. "
+                                             "The columns of the calculated and experimental data hold the groups one after the other.")
+    pjoint.add_argument("--groups", "-g", type=int, nargs='+', required=True, help="Number of observables of each group")
+    pjoint.add_argument("--sigma2", type=float, nargs='+', help="Variance of the gaussian error of each group. Default 1")
+    pjoint.add_argument("--scale", nargs='+', help="Scale factor of each group, or fit to rescale it to the experimental data (RDCs). Default 1")
+    pjoint.add_argument("--method", default='BFGS', help="scipy.optimize.minimize method. Default BFGS")
+    pjoint.add_argument("--chunksize", type=int, help="Rows of the calculated data per block. Default all, or blocks of 65536 rows for .npy files")
+    pjoint.add_argument("--jobs", "-j", type=int, help="Number of threads evaluating blocks of the calculated data. Default 1")
+    pjoint.add_argument("--prior", help="Prior weights of the structures (e.g. from enhanced sampling or cluster sizes), a numpy array or a text file of shape (M,). Default uniform")
+    pjoint.set_defaults(run=run_joint)
+
+    pcv = commands.add_parser('cv', parents=[data], help="Choose sigma2 by cross-validation over the observables",
+                              description="Cross-validation of sigma2: each fold of observables is held out in turn, "
+                                          "the rest are fitted and the rmsd of the held-out observables is scored.")
+    pcv.add_argument("--sigma2", type=float, nargs='+', required=True, help="Values of sigma2 to score")
+    pcv.add_argument("--folds", type=int, default=5, help="Number of folds of observables. Default 5")
+    pcv.add_argument("--seed", type=int, help="Seed of the random split of the observables")
+    pcv.add_argument("--method", default='trust-exact', help="scipy.optimize.minimize method. Default trust-exact")
+    pcv.add_argument("--chunksize", type=int, help="Rows of the calculated data per block. Default all, or blocks of 65536 rows for .npy files")
+    pcv.add_argument("--jobs", "-j", type=int, help="Number of processes running the folds. Default 1")
+    pcv.add_argument("--prior", help="Prior weights of the structures, a numpy array or a text file of shape (M,). Default uniform")
+    pcv.set_defaults(run=run_cv)
+
+    pres = commands.add_parser('resample', parents=[data], help="Bootstrap or jackknife errors of the averages, n_eff and weights",
+                               description="Uncertainty of the fit by resampling the structures or the observables")
+    pres.add_argument("--resampling", choices=['bootstrap', 'jackknife'], default='bootstrap', help="Default bootstrap")
+    pres.add_argument("--kind", choices=['structures', 'observables'], default='structures', help="What is resampled. Default structures")
+    pres.add_argument("--n", type=int, help="Number of bootstrap replicates (default 100) or of jackknife groups (default 20 groups of structures, or every observable)")
+    pres.add_argument("--sigma2", type=float, default=0.0, help="Variance of the gaussian error model. Default 0")
+    pres.add_argument("--seed", type=int, help="Seed of the bootstrap replicates")
+    pres.add_argument("--method", default='trust-exact', help="scipy.optimize.minimize method. Default trust-exact")
+    pres.add_argument("--chunksize", type=int, help="Rows of the calculated data per block. Default all, or blocks of 65536 rows for .npy files")
+    pres.add_argument("--jobs", "-j", type=int, help="Number of processes running the replicates. Default 1")
+    pres.add_argument("--prior", help="Prior weights of the structures, a numpy array or a text file of shape (M,). Default uniform")
+    pres.add_argument("--save", "-s", help="Save the mean and standard deviation of the averaged data in text or numpy format (according to extension)")
+    pres.add_argument("--save_weights", "-sw", help="Save the mean and standard deviation of the weights in text or numpy format (according to extension)")
+    pres.set_defaults(run=run_resample)
+    return parser
+
+def _pyplot(args):
+    """
+    return matplotlib.pyplot if something has to be drawn, else None
+    """
+    if args.no_plot and not args.save_image:
+        return None
+    import matplotlib
+    if args.no_plot: matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    if not args.no_plot: plt.ion()
+    return plt
+
+def _load(args):
+    """
+    return the residue numbers, the experimental data and the calculated data
+    of the residues to fit
+    """
+    resind, Q = load_experimental(args.experimental)
+    q = load(args.calculated)
+    columns = residues(len(Q), args.initial_residue, args.final_residue)
+    if len(columns) != len(Q):
+        sys.exit("The residues to fit ({}) and the experimental data ({}) do not match.".format(len(columns), len(Q)))
+    if columns[0] < 0 or columns[-1] >= q.shape[1]:
+        sys.exit("The calculated data have {} residues, fewer than the residues to fit.".format(q.shape[1]))
+    # The columns are selected block by block, so a memory-mapped q is not copied
+    if len(columns) != q.shape[1]:
+        q = Columns(q, columns)
+    if args.dtype and q.dtype != args.dtype:
+        q = np.asarray(q, dtype=args.dtype)
+    return resind, Q, q
+
+def _prior(args, q):
+    """
+    return the prior weights of the structures, or None for a uniform prior
+    """
+    if not args.prior:
+        return None
+    prior = np.asarray(load(args.prior), dtype=float)
+    if prior.shape != (len(q),):
+        sys.exit("The prior has {} values for {} structures.".format(prior.size, len(q)))
+    return prior
+
+def _header(columns):
+    print ("="*50)
+    print (" "*15, " Maximum Entropy Fit")
+    print ("="*50)
+    print (columns)
+    print ("="*50)
+
+def _set_wlim(axw, w_opt):
+    n = len(w_opt)
+    axw.set_ylim(10**np.floor(np.log10(np.min(n*w_opt))),10**np.ceil(np.log10(np.max(n*w_opt))))
+
+def _names(args, n):
+    """
+    return the names of the n structures, or None
+    """
+    if not args.names:
+        return None
+    names = sparse.read_names(args.names)
+    if len(names) != n:
+        sys.exit("{} has {} names for {} structures.".format(args.names, len(names), n))
+    return names
+
+def _plotted_weights(args, w_opt):
+    """
+    return the sorted weights (times the number of structures) to plot: all of
+    them, or the ones kept by --sparse
+    """
+    if args.sparse:
+        return len(w_opt)*sparse.support(w_opt, args.sparse)[1][::-1]
+    return np.sort(w_opt*len(w_opt))
+
+def _save(args, resind, qnew, w_opt, plt):
+    names = _names(args, len(w_opt)) if args.top or args.sparse else None
+    if args.top:
+        order = np.argsort(w_opt)[::-1][:args.top]
+        for i in order:
+            print("{:10d} {:12.4e}  {}".format(i, w_opt[i], "" if names is None else names[i]))
+    if args.sparse:
+        indices, weights = sparse.support(w_opt, args.sparse)
+        print("{} of {} structures hold {:.1%} of the weight.".format(len(indices), len(w_opt), weights.sum()))
+    if args.save:
+        save(args.save, np.c_[resind, qnew])
+    if args.save_weights and args.sparse:
+        sparse.save(args.save_weights, indices, weights, len(w_opt), names)
+    elif args.save_weights:
+        save(args.save_weights, w_opt)
+    if args.save_image:
+        plt.savefig(args.save_image)
+    if not args.no_plot: input()
+
+def run_rdc(args):
+    """
+    fit RDCs, bracketing k until the rmsd is below sigma2
+    """
+    if args.dtype == 'float32':
+        sys.exit("The RDCs are fitted in double precision: --dtype float32 is for cs, joint, cv and resample.")
+    plt = _pyplot(args)
+    # The RDCs are fitted with the sign of the weights exponent reversed: the
+    # weights of -q with lambdas lam are those of q with -lam, and the rescaled
+    # averages of -q fitted to Q are minus those of q fitted to -Q. So q is fitted
+    # to -Q and the lambdas and averages are changed of sign back.
+    resind, Q, q = _load(args)
+    if q.dtype != np.float64:
+        # A single precision file is read once in double precision
+        q = np.asarray(q, dtype=float)
+    lam = np.zeros(len(Q)) #Lambda initialization
+
+    if plt:
+        # Generate initial plot
+        fig = plt.figure(figsize=(11, 6))
+        ax = fig.add_subplot(121)
+        ax.plot(resind, Q, 'o-', label='experimental')
+        qnew = -rdc.scaled_qave(lam, q, -Q)
+        ax.plot(resind, qnew, 'x-', label='inital')
+        axw = fig.add_subplot(122)
+        line, = ax.plot(resind, qnew, 'o-', label='re-weighted')
+        #Plot Weights
+        wplot, = axw.semilogy(np.ones(len(q)), '-')
+        axw.set_ylim(0.1,10)
+        plt.draw()
+
+    _header("%9s %12s %18s " %('Fit','k','Lambda'))
+    print("{:10.3f} {:15.1f} {:15.3e}".format(rdc.rmsd(lam, q, -Q), args.k, 0.0))
+
+    def report(lam, k, fit):
+        avelam = np.sqrt(np.dot(lam, lam)/len(lam))
+        print("{:10.3f} {:15.1f} {:15.3e}" .format(fit, k, avelam))
+        if plt:
+            line.set_ydata(-rdc.scaled_qave(lam, q, -Q))
+            wplot.set_ydata(np.sort(w(lam,q)*len(q)))
+            plt.draw()
+
+    lam, k = rdc.fit(q, -Q, args.sigma2, args.k, error=args.error, callback=report)
+    qnew = -rdc.scaled_qave(lam, q, -Q)
+    w_opt = w(lam, q)
+    if plt:
+        line.set_ydata(qnew)
+        wplot.set_ydata(np.sort(w_opt*len(q)))
+        ax.legend(fontsize='small', loc='best')
+        _set_wlim(axw, w_opt)
+        if not args.no_plot: plt.show()
+    _save(args, resind, qnew, w_opt, plt)
+
+def run_cs(args):
+    """
+    fit data that are not rescaled, minimizing gamma
+    """
+    plt = _pyplot(args)
+    resind, Q, q = _load(args)
+    lam = np.zeros(len(Q)) #Lambda initialization
+    try:
+        sigma2 = float(args.sigma2)
+    except ValueError:
+        try:
+            sigma2 = np.load(args.sigma2)
+        except FileNotFoundError:
+            sys.exit("File {} for sigma2 not found.".format(args.sigma2))
+    if type(sigma2) is float:
+        sigma2 = sigma2*np.ones_like(lam)
+    elif len(sigma2)!=len(lam):
+        sys.exit("sigma2 size is different from the number of observables.")
+
+    _header("%9s %18s " %('Fit','Lambda'))
+    prior = _prior(args, q)
+    print("{:10.3f}  {:15.3e}".format(cs.rmsd(lam, q, Q, args.chunksize, prior), 0.0))
+    if args.reduce is not None or args.clusters:
+        lam, w_opt, info = reduction.fit(q, Q, sigma2, args.reduce or 0., args.clusters,
+                                         method=args.method, full_output=True, prior=prior,
+                                         chunksize=args.chunksize, n_jobs=args.jobs)
+        qnew, fit = info['qave'], info['rmsd']
+    else:
+        lam = cs.fit(q, Q, sigma2, method=args.method, chunksize=args.chunksize, n_jobs=args.jobs,
+                     prior=prior)
+        qnew = qave(lam, q, args.chunksize, prior)
+        w_opt = w(lam, q, args.chunksize, prior=prior)
+        fit = cs.rmsd(lam, q, Q, args.chunksize, prior)
+    if args.refit_support:
+        if not args.sparse:
+            sys.exit("--refit_support needs --sparse.")
+        lam, indices, weights = sparse.refit(q, Q, sigma2, sparse.support(w_opt, args.sparse)[0], prior,
+                                             method=args.method, n_jobs=args.jobs)
+        w_opt = sparse.dense(indices, weights, len(q))
+        qnew = np.dot(weights, q[indices])
+        fit = np.sqrt(np.mean((qnew - Q)**2))
+        print("Fitted again on {} structures.".format(len(indices)))
+    avelam = np.sqrt(np.dot(lam, lam)/len(lam))
+    print("{:10.3f}  {:15.3e}".format(fit, avelam))
+    print("="*10*len(lam))
+    print((len(lam)*"{:8.2e} ").format(*lam))
+    if args.reduce is not None or args.clusters:
+        print("{} structures reduced to {} representatives. The reduction changes the rmsd by at most {:.3g}."
+              .format(len(q), info['n_reduced'], info['rmsd_bound']))
+    if plt:
+        fig = plt.figure(figsize=(11, 6))
+        ax = fig.add_subplot(121)
+        if args.plot_errors:
+            ax.plot(resind, qave(np.zeros_like(lam), q, args.chunksize, prior)-Q, 'x-', label='inital error')
+            ax.plot(resind, qnew-Q, 'o-', label='re-weighted error')
+            ax.hlines(0, resind[0], resind[-1])
+        else:
+            ax.plot(resind, Q, 'o-', label='experimental')
+            ax.plot(resind, qave(np.zeros_like(lam), q, args.chunksize, prior), 'x-', label='inital')
+            ax.plot(resind, qnew, 'o-', label='re-weighted')
+            ax.plot(resind, Q+lam*sigma2, 's-', label="Exp. + error")
+        #Plot Weights
+        axw = fig.add_subplot(122)
+        axw.semilogy(_plotted_weights(args, w_opt), '-')
+        ax.legend(fontsize='small', loc='best')
+        _set_wlim(axw, w_opt)
+        plt.draw()
+    _save(args, resind, qnew, w_opt, plt)
+
+def run_joint(args):
+    """
+    fit several groups of observables together, reporting the fit of each group
+    """
+    plt = _pyplot(args)
+    resind, Q, q = _load(args)
+    prior = _prior(args, q)
+    ngroups = len(args.groups)
+    sigma2 = args.sigma2 or [1.0]*ngroups
+    try:
+        scale = [None if f == 'fit' else float(f) for f in args.scale or ['1']*ngroups]
+    except ValueError:
+        sys.exit("The scale of each group has to be a number or fit.")
+    try:
+        lam, info = joint.fit(q, Q, args.groups, sigma2, scale, full_output=True, method=args.method,
+                              chunksize=args.chunksize, n_jobs=args.jobs, prior=prior)
+    except ValueError as error:
+        sys.exit(str(error))
+
+    _header("%5s %12s %12s %12s " %('Group','Scale','RMSD','chi2'))
+    for i, group in enumerate(info['groups']):
+        print("{:5d} {:12.4g} {:12.4f} {:12.4f}".format(i+1, group['scale'], group['rmsd'], group['chi2']))
+    print("="*50)
+    print("n_eff: {:.4f}, passes over the data: {}".format(info['n_eff'], info['npass']))
+
+    qnew = info['qave']
+    w_opt = w(lam, q, args.chunksize, prior=prior)
+    if plt:
+        fig = plt.figure(figsize=(11, 6))
+        ax = fig.add_subplot(121)
+        ax.plot(Q, qnew, 'o')
+        ax.plot([Q.min(), Q.max()], [Q.min(), Q.max()], '-')
+        ax.set_xlabel('experimental')
+        ax.set_ylabel('re-weighted')
+        #Plot Weights
+        axw = fig.add_subplot(122)
+        axw.semilogy(_plotted_weights(args, w_opt), '-')
+        _set_wlim(axw, w_opt)
+        plt.draw()
+    _save(args, resind, qnew, w_opt, plt)
+
+def run_cv(args):
+    """
+    score each sigma2 by cross-validation and report the best one
+    """
+    resind, Q, q = _load(args)
+    result = validation.cross_validate(q, Q, args.sigma2, args.folds, args.method, args.seed,
+                                       args.jobs, args.chunksize, _prior(args, q))
+    _header("%12s %15s %15s " %('sigma2','CV RMSD','Train RMSD'))
+    for sigma2, cv, train in zip(args.sigma2, result['cv_rmsd'], result['train_rmsd']):
+        print("{:12.4g} {:15.4f} {:15.4f}".format(sigma2, cv, train))
+    print("="*50)
+    print("Selected sigma2: {:.4g}".format(args.sigma2[np.argmin(result['cv_rmsd'])]))
+
+def run_resample(args):
+    """
+    bootstrap or jackknife the fit and report the errors of the averages and n_eff
+    """
+    resind, Q, q = _load(args)
+    options = dict(kind=args.kind, method=args.method, n_jobs=args.jobs, chunksize=args.chunksize,
+                   prior=_prior(args, q), weights=bool(args.save_weights))
+    if args.resampling == 'bootstrap':
+        result = resampling.bootstrap(q, Q, args.sigma2, args.n or 100, seed=args.seed, **options)
+    else:
+        result = resampling.jackknife(q, Q, args.sigma2, args.n, **options)
+    _header("%9s %12s %12s %12s " %('Residue','Exp.','Average','Std. dev.'))
+    for r, Qr, qa, std in zip(resind, Q, result['qave'], result['qave_std']):
+        print("{:9d} {:12.4f} {:12.4f} {:12.4f}".format(r, Qr, qa, std))
+    print("="*50)
+    print("n_eff: {:.4f} +- {:.4f} ({} replicates)".format(result['n_eff'], result['n_eff_std'], result['n']))
+    if args.save:
+        save(args.save, np.c_[resind, result['qave'], result['qave_std']])
+    if args.save_weights:
+        save(args.save_weights, np.c_[result['w'], result['w_std']])
+
+def main(argv=None):
+    """
+    run the maxent command with the arguments argv (default sys.argv[1:])
+    """
+    args = _parser().parse_args(argv)
+    args.run(args)
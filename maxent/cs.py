@@ -0,0 +1,348 @@
+"""
+Maximum entropy fit of data that need not and cannot be rescaled, such as
+chemical shifts.
+
+This vesion includes a better way to include errors based on:
+https://arxiv.org/abs/1801.05247
+
+sigma2 is the error in the exp. data assumed to be normally distributed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .kernel import (_blocks, _pblocks, _qdot, _tdot, _qxq, _precision, _partial, _lse,
+                     _merge, _pmap, _reduce, _logz, _logprior, _kish, _batch_partial, _batch_merge, w, qave)
+
+
+def _grad_gamma(lam, q, Q, sigma2, chunksize=None, prior=None):
+    """
+    return the gradient of gamma with respect to lam. Eq. 33
+    """
+    return Q - qave(lam, q, chunksize, prior) + lam*sigma2
+
+def _gamma(lam, q, Q, sigma2, chunksize=None, prior=None):
+    """
+    Return the gamma function. Eq. 34.
+    """
+    gamma = _logz(_reduce(lam, q, chunksize, _logprior(prior))) + np.dot(Q, lam)
+    gamma += 0.5*np.dot(sigma2, lam**2) #Gaussian error. See eq. 21
+    return gamma
+
+
+class _Gamma:
+    """
+    Fused evaluation of gamma, its gradient, Hessian and the weights.
+    The last evaluation is cached, so each new lam costs one pass over q
+    (two GEMVs per block, no (N,M) temporaries). npass counts the passes over q.
+    With a memory-mapped q or an iterable of blocks the passes are streamed
+    and the weights are not kept in memory. With a thread pool the blocks
+    are evaluated concurrently and their partial results merged exactly.
+    logprior is log(N*p) for a prior p of the rows of q (see _partial).
+    eps is the precision of the averages, nonzero for a single precision q.
+    The exponents of a single precision q are then kept in double precision
+    and updated with the product of q with the change of lam: only this
+    product is rounded to single precision, so gamma stays smooth near the
+    minimum, as the trust-region methods need.
+    """
+    def __init__(self, q, Q, sigma2, chunksize=None, pool=None, n_jobs=1, logprior=None):
+        self.q = q
+        self.Q = Q
+        self.sigma2 = sigma2
+        self.logprior = logprior
+        self.chunksize = chunksize
+        self.pool = pool
+        self.n_jobs = n_jobs
+        self.lam = None
+        self.npass = 0
+        self.eps = _precision(q)
+        self.x = None
+
+    def _map(self, func):
+        """
+        yield func(i, block, logprior) for each block of q, its index and the
+        log prior of its rows
+        """
+        return _pmap(lambda item: func(item[0], *item[1]),
+                     enumerate(_pblocks(self.q, self.chunksize, self.logprior)),
+                     self.pool, self.n_jobs)
+
+    def __call__(self, lam):
+        """
+        return gamma and its gradient, as scipy.optimize.minimize(jac=True) expects
+        """
+        self.evaluate(lam)
+        return self.gamma, self.grad
+
+    def evaluate(self, lam):
+        """
+        compute gamma, its gradient and the weights unless lam is the cached one
+        """
+        if self.lam is not None and np.array_equal(lam, self.lam):
+            return
+        state = None
+        nblocks = 0
+        if self.eps:
+            last, xlast, xnew = self.lam, self.x, {}
+            def exponents(i, block, lp):
+                if xlast is None:
+                    x = _qdot(block, -lam)
+                    if lp is not None: x += lp
+                else:
+                    x = xlast[i] + _qdot(block, last - lam)
+                xnew[i] = x.copy()
+                return _lse(x, block)
+            parts = self._map(exponents)
+        else:
+            parts = self._map(lambda i, block, lp: _partial(lam, block, lp))
+        for part, x in parts:
+            state = _merge(state, part)
+            nblocks += 1
+        if self.eps: self.x = xnew
+        # Keep the weights only if q was not streamed
+        self.w = x/state[1] if nblocks == 1 else None
+        self.lognorm = state[0] + np.log(state[1])
+        self.qave = state[2]/state[1]
+        self.n_eff = _kish(state, self.logprior)
+        self.gamma = _logz(state) + np.dot(self.Q, lam)
+        self.gamma += 0.5*np.dot(self.sigma2, lam**2) #Gaussian error. See eq. 21
+        self.grad = self.Q - self.qave + lam*self.sigma2
+        self.lam = np.array(lam, copy=True)
+        self.npass += 1
+
+    def _weighted_map(self, func):
+        """
+        yield func(block, weights) for each block of q and its normalized weights
+        """
+        if self.w is not None:
+            return iter([func(next(_blocks(self.q, self.chunksize)), self.w)])
+        lam, lognorm, xlast = self.lam, self.lognorm, self.x
+        def weights(i, block, lp):
+            if xlast is not None:
+                return np.exp(xlast[i] - lognorm)
+            x = _qdot(block, -lam) - lognorm
+            if lp is not None: x += lp
+            return np.exp(x, out=x)
+        return self._map(lambda i, block, lp: func(block, weights(i, block, lp)))
+
+    def hess(self, lam):
+        """
+        return the Hessian of gamma: the weighted covariance of q plus diag(sigma2)
+        """
+        self.evaluate(lam)
+        self.npass += 1
+        h = -np.outer(self.qave, self.qave)
+        for part in self._weighted_map(_qxq):
+            h += part
+        h[np.diag_indices_from(h)] += self.sigma2
+        return h
+
+    def hessp(self, lam, p):
+        """
+        return the product of the Hessian of gamma with the vector p
+        """
+        self.evaluate(lam)
+        self.npass += 1
+        hp = self.sigma2*p - self.qave*np.dot(self.qave, p)
+        for part in self._weighted_map(lambda block, wb: _tdot(wb*_qdot(block, p), block)):
+            hp += part
+        return hp
+
+
+def rmsd(lam, q, Q, chunksize=None, prior=None):
+    """
+    Return the RMSD between experiental and calculated values.
+    """
+    qa = qave(lam, q, chunksize, prior)
+    vec = qa - Q
+    return np.sqrt(np.dot(vec, vec)/len(Q))
+
+def _minimize(fun, lam, method):
+    """
+    minimize gamma with scipy, passing the analytic Hessian to the methods that use it.
+    With a single precision q the gradient is not more precise than the
+    averages (fun.eps), which bounds the tolerances.
+    """
+    import scipy.optimize as so
+    options = {}
+    eps = getattr(fun, 'eps', 0.)
+    if eps and method.lower() in ('trust-ncg', 'trust-krylov', 'trust-exact', 'dogleg'):
+        options['gtol'] = eps*np.sqrt(len(lam)) #norm of the gradient
+    elif eps and method.lower() in ('bfgs', 'cg', 'l-bfgs-b'):
+        options['gtol'] = eps
+    if method.lower() in ('newton-cg', 'trust-ncg', 'trust-krylov'):
+        return so.minimize(fun, lam, jac=True, method=method, hessp=fun.hessp, options=options)
+    elif method.lower() in ('trust-exact', 'dogleg'):
+        return so.minimize(fun, lam, jac=True, method=method, hess=fun.hess, options=options)
+    return so.minimize(fun, lam, jac=True, method=method, options=options)
+
+
+def fit(q,Q, sigma2, lam=None, method='BFGS', full_output=False, chunksize=None,
+        n_jobs=None, prior=None):
+    """
+    Optimize the lambdas.
+    Input:
+    q - array of shape (N,M) with N structures and M observables (Chemical shifts).
+      It can be memory-mapped (see load), some kernel.Columns of a larger array,
+      or an iterable of arrays of shape (n,M) that can be traversed more than
+      once; each iteration is then a streaming pass.
+    Q - array of shape (M,) with M experimental observables (Chemical Shifts).
+    method - any scipy.optimize.minimize method. Newton-CG, trust-ncg and
+      trust-krylov use the analytic Hessian-vector product, trust-exact and
+      dogleg the analytic Hessian; they converge in a few passes over q.
+    full_output - if True, also return a dictionary with the number of
+      iterations (nit), of passes over q (npass), the convergence status and
+      gamma, qave and n_eff at the optimized lambdas.
+    chunksize - number of rows of q per block. Defaults to the whole array, or
+      to blocks of _CHUNK rows for memory-mapped arrays.
+    n_jobs - number of threads evaluating blocks of q concurrently. An in-memory
+      q is split into n_jobs shards unless chunksize is given. Default 1.
+    prior - prior weights of the N structures (e.g. from enhanced sampling or
+      cluster sizes), not necessarily normalized. Default uniform. n_eff is
+      then relative to the Kish size of the prior.
+    q can be single precision (float32, see io.load): the products with q are
+    then done in single precision and the sums in double precision.
+    """
+    #Minimize
+    if lam is None:
+        lam = np.zeros(len(Q)) #Lambda initialization
+    if type(sigma2) is float or sigma2.size==1:
+        sigma2 = sigma2*np.ones_like(lam)
+    logprior = _logprior(prior)
+
+    if not n_jobs or n_jobs == 1:
+        fun = _Gamma(q, Q, sigma2, chunksize, logprior=logprior)
+        result = _minimize(fun, lam, method)
+        fun.evaluate(result.x)
+    else:
+        if chunksize is None and type(q) is np.ndarray:
+            chunksize = -(-len(q)//n_jobs)
+        with ThreadPoolExecutor(n_jobs) as pool:
+            fun = _Gamma(q, Q, sigma2, chunksize, pool, n_jobs, logprior)
+            result = _minimize(fun, lam, method)
+            fun.evaluate(result.x)
+    if not result.success: print("Minimisation not converged!")
+    if full_output:
+        info = {'nit': result.nit, 'npass': fun.npass,
+                'success': result.success, 'message': result.message,
+                'gamma': fun.gamma, 'qave': fun.qave, 'n_eff': fun.n_eff}
+        return result.x, info
+    return result.x
+
+
+def fit_path(q, Q, sigma2, thetas, target_chi2=None, target_neff=None,
+             weights_out=None, **kwargs):
+    """
+    Follow the regularization path (L-curve) from large to small errors.
+    The point for each theta is fitted with the error sigma2*theta, starting
+    from the lambdas of the previous point, and the path stops as soon as the
+    chi2 reaches target_chi2 or n_eff drops below target_neff.
+    Input:
+    q, Q, sigma2 - as in fit. sigma2 is the experimental error, used for the chi2.
+    thetas - scale factors of sigma2, visited from largest to smallest.
+    weights_out - format string with the point index (e.g. 'w_{}.npy'); if given,
+      the weights of each point are written to memory-mapped .npy files.
+    Other keyword arguments (method, chunksize, n_jobs, prior...) are passed to fit.
+    Returns a dictionary with theta, lam, rmsd, chi2, n_eff and gamma for each
+    point of the path, and the list of weights w.
+    """
+    chunksize = kwargs.get('chunksize')
+    sigma2 = sigma2*np.ones(len(Q))
+    path = {'theta': [], 'lam': [], 'rmsd': [], 'chi2': [], 'n_eff': [],
+            'gamma': [], 'w': []}
+    lam = None
+    for i, theta in enumerate(sorted(thetas, reverse=True)):
+        lam, info = fit(q, Q, theta*sigma2, lam=lam, full_output=True, **kwargs)
+        vec = info['qave'] - Q
+        chi2 = np.mean(vec**2/sigma2)
+        out = None if weights_out is None else weights_out.format(i)
+        for key, value in zip(path, (theta, lam, np.sqrt(np.mean(vec**2)), chi2,
+                                     info['n_eff'], info['gamma'],
+                                     w(lam, q, chunksize, out, kwargs.get('prior')))):
+            path[key].append(value)
+        if target_chi2 is not None and chi2 <= target_chi2: break
+        if target_neff is not None and info['n_eff'] <= target_neff: break
+    for key in path:
+        if key != 'w': path[key] = np.array(path[key])
+    return path
+
+
+def fit_many(q, Q, sigma2_list, lam=None, gtol=1e-6, maxiter=100, chunksize=None,
+             n_jobs=None, prior=None):
+    """
+    Optimize the lambdas for several sigma2 (or several data sets) at once.
+    All the problems are solved together by a damped Newton method: each pass
+    over q evaluates gamma, the gradient and the Hessian of every problem with
+    (N,M)x(M,K) matrix products, so a scan costs one pass per iteration instead of K.
+    Input:
+    q - array of shape (N,M) (see fit for memory-mapped and blocked q).
+    Q - array of shape (M,), or (K,M) with a data set per problem.
+    sigma2_list - K values of sigma2, each a float or an array of shape (M,).
+    lam - initial lambdas of shape (K,M). Default zeros.
+    prior - prior weights of the N structures (see fit). Default uniform.
+    Returns a dictionary with the lambdas (K,M) and the rmsd, n_eff, gamma and
+    convergence status (success, the gradient below gtol) of each problem,
+    together with the number of iterations and passes over q.
+    """
+    sigma2 = np.array([s*np.ones(np.shape(Q)[-1]) for s in sigma2_list])
+    K, M = sigma2.shape
+    Q = np.broadcast_to(Q, (K, M))
+    lams = np.zeros((K, M)) if lam is None else np.array(lam, dtype=float)
+    logprior = _logprior(prior)
+    if n_jobs and n_jobs > 1:
+        if chunksize is None and type(q) is np.ndarray:
+            chunksize = -(-len(q)//n_jobs)
+        pool = ThreadPoolExecutor(n_jobs)
+    else:
+        pool = None
+    npass = 0
+
+    def evaluate(idx, lams):
+        state = None
+        for part in _pmap(lambda item: _batch_partial(lams, *item),
+                          _pblocks(q, chunksize, logprior), pool, n_jobs):
+            state = _batch_merge(state, part)
+        qa = state[2]/state[1][:,None]
+        res = {'qave': qa,
+               'gamma': state[0] + np.log(state[1]/state[4]) + np.einsum('km,km->k', Q[idx], lams)
+                        + 0.5*np.einsum('km,km->k', sigma2[idx], lams**2),
+               'grad': Q[idx] - qa + lams*sigma2[idx],
+               'n_eff': _kish(state, logprior)}
+        hess = state[5]/state[1][:,None,None] - qa[:,:,None]*qa[:,None,:]
+        hess[:, np.arange(M), np.arange(M)] += sigma2[idx]
+        res['step'] = -np.linalg.solve(hess, res['grad'][:,:,None])[:,:,0]
+        return res
+
+    try:
+        cur = evaluate(np.arange(K), lams)
+        npass += 1
+        # Precision of the averages, and of the exponents q*lam, with a single precision q
+        eps = _precision(q)
+        gtol = max(gtol, eps)
+        t = np.ones(K)
+        nit = 0
+        while nit < maxiter:
+            active = np.abs(cur['grad']).max(1) > gtol
+            if not active.any(): break
+            nit += 1
+            idx = np.flatnonzero(active)
+            trial = lams[idx] + t[idx,None]*cur['step'][idx]
+            new = evaluate(idx, trial)
+            npass += 1
+            # Armijo condition, per problem
+            slope = np.einsum('km,km->k', cur['grad'][idx], cur['step'][idx])
+            ok = new['gamma'] <= cur['gamma'][idx] + 1e-4*t[idx]*slope + eps*np.abs(trial).sum(1)
+            ok |= t[idx] < 1e-10
+            acc = idx[ok]
+            lams[acc] = trial[ok]
+            for key in cur:
+                cur[key][acc] = new[key][ok]
+            t[acc] = 1.
+            t[idx[~ok]] *= 0.5
+    finally:
+        if pool is not None: pool.shutdown()
+    success = np.abs(cur['grad']).max(1) <= gtol
+    if not success.all(): print("Minimisation not converged!")
+    vec = cur['qave'] - Q
+    return {'lam': lams, 'rmsd': np.sqrt((vec**2).mean(1)), 'n_eff': cur['n_eff'],
+            'gamma': cur['gamma'], 'success': success, 'nit': nit, 'npass': npass}
@@ -0,0 +1,206 @@
+"""
+Incremental fit of an ensemble that grows as more structures are computed.
+
+The structures are kept in blocks of rows, and the log-sum-exp state of each
+block (with its weighted first and second moments, see kernel._batch_partial)
+is cached at the last fitted lambdas. When new blocks are appended, the old
+blocks are replaced by the second order expansion of their log-sum-exp around
+the cached lambdas, so the fit of the old model plus the new rows costs passes
+over the new rows only. This prediction warm-starts a few correction sweeps
+over all the blocks, which make the fit exact again, and a last pass caches
+the states at the new lambdas.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .kernel import _CHUNK, _pmap, _batch_partial, _batch_merge, w
+from .cs import _Gamma, _minimize
+
+
+def _log(prior):
+    """
+    return the log of the prior weights of a block, or None for a uniform prior
+    """
+    if prior is None: return None
+    if (np.asarray(prior) < 0).any():
+        raise ValueError("The prior weights must be non-negative")
+    with np.errstate(divide='ignore'):
+        return np.log(np.asarray(prior, dtype=float))
+
+
+class _Predictor:
+    """
+    gamma of the old blocks, expanded to second order around the cached
+    lambdas, plus the new blocks, evaluated exactly.
+    With a log prior of the rows (not normalized), logP is the log of its sum
+    (of the number of rows for a uniform prior).
+    """
+    def __init__(self, old, lam0, new, Q, sigma2, logP):
+        self.logS0 = old[0][0] + np.log(old[1][0])
+        self.mu = old[2][0]/old[1][0]
+        self.C = old[5][0]/old[1][0] - np.outer(self.mu, self.mu)
+        self.lam0 = lam0
+        self.new = new
+        self.Q = Q
+        self.sigma2 = sigma2
+        self.logP = logP
+        self.lam = None
+        self.npass = 0
+
+    def evaluate(self, lam):
+        """
+        compute gamma, its gradient and Hessian unless lam is the cached one
+        """
+        if self.lam is not None and np.array_equal(lam, self.lam):
+            return
+        d = lam - self.lam0
+        lo = self.logS0 - np.dot(self.mu, d) + 0.5*np.dot(d, np.dot(self.C, d))
+        go = np.dot(self.C, d) - self.mu
+        state = None
+        for block, lp in self.new:
+            state = _batch_merge(state, _batch_partial(lam[None], block, lp))
+        ln = state[0][0] + np.log(state[1][0])
+        gn = -state[2][0]/state[1][0]
+        hn = state[5][0]/state[1][0] - np.outer(gn, gn)
+        logS = np.logaddexp(lo, ln)
+        a = np.exp(lo - logS)
+        g = a*go + (1-a)*gn
+        h = a*(self.C + np.outer(go, go)) + (1-a)*(hn + np.outer(gn, gn)) - np.outer(g, g)
+        self.gamma = logS - self.logP + np.dot(self.Q, lam) + 0.5*np.dot(self.sigma2, lam**2)
+        self.grad = self.Q + g + lam*self.sigma2
+        self.h = h + np.diag(self.sigma2)
+        self.lam = np.array(lam, copy=True)
+        self.npass += 1
+
+    def __call__(self, lam):
+        self.evaluate(lam)
+        return self.gamma, self.grad
+
+    def hess(self, lam):
+        self.evaluate(lam)
+        return self.h
+
+    def hessp(self, lam, p):
+        self.evaluate(lam)
+        return np.dot(self.h, p)
+
+
+class IncrementalFit:
+    """
+    Fit of the lambdas of an ensemble that grows by appending structures.
+    Input:
+    Q - array of shape (M,) with M experimental observables.
+    sigma2 - error of the experimental data, a float or an array of shape (M,).
+    method - scipy.optimize.minimize method of the fits (see cs.fit).
+    chunksize - the appended structures are cached in blocks of chunksize rows.
+    n_jobs - number of threads evaluating the blocks concurrently. Default 1.
+
+    fit = IncrementalFit(Q, 0.5)
+    lam = fit.append(q)      # a normal fit
+    lam = fit.append(q_new)  # passes over q_new plus a few over all the blocks
+    """
+    def __init__(self, Q, sigma2, method='trust-exact', chunksize=_CHUNK, n_jobs=None):
+        self.Q = np.asarray(Q, dtype=float)
+        self.sigma2 = sigma2*np.ones(len(self.Q))
+        self.method = method
+        self.chunksize = chunksize
+        self.n_jobs = n_jobs
+        self.blocks = []
+        self.logp = []   #log prior of each block, not normalized, or None
+        self.cache = []  #batched log-sum-exp state of each block at lam, or None
+        self.lam = np.zeros(len(self.Q))
+        self.npass = 0
+
+    def __len__(self):
+        return sum(len(block) for block in self.blocks)
+
+    def append(self, q, prior=None, refit=True, full_output=False):
+        """
+        Append the structures of q, an array of shape (n,M), with their prior
+        weights (on the same scale as those of the previous structures; default
+        uniform), and fit again unless refit is False.
+        Returns the lambdas, and the information of fit if full_output.
+        """
+        if self.blocks and (prior is None) != (self.logp[0] is None):
+            raise ValueError("Either all or none of the structures need a prior")
+        if np.shape(q)[1] != len(self.Q):
+            raise ValueError("q has {} observables and Q {}".format(np.shape(q)[1], len(self.Q)))
+        logp = _log(prior)
+        for i in range(0, len(q), self.chunksize):
+            self.blocks.append(q[i:i+self.chunksize])
+            self.logp.append(None if logp is None else logp[i:i+self.chunksize])
+            self.cache.append(None)
+        if refit:
+            return self.fit(full_output)
+        return self.lam
+
+    def _logP(self):
+        """
+        return the log of the sum of the prior weights (of the number of rows)
+        """
+        if self.logp[0] is None:
+            return np.log(len(self))
+        return np.logaddexp.reduce(np.concatenate(self.logp))
+
+    def _logprior(self):
+        """
+        return the normalized log prior of all the rows (see kernel._logprior)
+        """
+        if self.logp[0] is None: return None
+        return np.concatenate(self.logp) + np.log(len(self)) - self._logP()
+
+    def prior(self):
+        """
+        return the prior weights of all the structures, or None if uniform
+        """
+        if self.logp[0] is None: return None
+        return np.exp(np.concatenate(self.logp))
+
+    def fit(self, full_output=False):
+        """
+        Fit the lambdas to all the structures appended so far, warm-started
+        from the prediction of the cached states if some blocks are new.
+        full_output - if True, also return a dictionary with the iterations of
+          the prediction (nit_predict) and of the correction (nit), the passes
+          over all the structures (npass, including the one caching the
+          states), the convergence status and gamma, qave and n_eff.
+        """
+        pool = ThreadPoolExecutor(self.n_jobs) if self.n_jobs and self.n_jobs > 1 else None
+        try:
+            lam, nit_predict = self.lam, 0
+            old = [i for i, c in enumerate(self.cache) if c is not None]
+            new = [i for i, c in enumerate(self.cache) if c is None]
+            if old and new:
+                state = None
+                for i in old:
+                    state = _batch_merge(state, self.cache[i])
+                pred = _Predictor(state, self.lam, [(self.blocks[i], self.logp[i]) for i in new],
+                                  self.Q, self.sigma2, self._logP())
+                result = _minimize(pred, lam, self.method)
+                lam, nit_predict = result.x, result.nit
+            fun = _Gamma(self.blocks, self.Q, self.sigma2, None, pool, self.n_jobs or 1,
+                         self._logprior())
+            result = _minimize(fun, lam, self.method)
+            fun.evaluate(result.x)
+            if not result.success: print("Minimisation not converged!")
+            self.lam = result.x
+            # Cache the states of all the blocks at the new lambdas
+            lam2 = self.lam[None]
+            self.cache = list(_pmap(lambda item: _batch_partial(lam2, *item),
+                                    zip(self.blocks, self.logp), pool, self.n_jobs))
+        finally:
+            if pool is not None: pool.shutdown()
+        self.npass += fun.npass + 1
+        if full_output:
+            info = {'nit_predict': nit_predict, 'nit': result.nit, 'npass': fun.npass + 1,
+                    'success': result.success, 'message': result.message,
+                    'gamma': fun.gamma, 'qave': fun.qave, 'n_eff': fun.n_eff}
+            return self.lam, info
+        return self.lam
+
+    def w(self, out=None):
+        """
+        return the weights of all the structures (see kernel.w)
+        """
+        return w(self.lam, self.blocks, out=out, prior=self.prior())
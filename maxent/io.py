@@ -0,0 +1,49 @@
+"""
+Reading and writing the arrays of MaxEnt.
+"""
+
+import numpy as np
+
+
+def load(filename, dtype=None):
+    """
+    Load an array from a numpy (memory-mapped, read only) or a text file.
+    dtype - if given (e.g. 'float32'), the array is converted to it. A numpy
+      file of another dtype is then read into memory; save it once converted
+      to keep it memory-mapped.
+    """
+    if filename.split(".")[-1] == "npy":
+        array = np.load(filename, mmap_mode='r')
+    else:
+        array = np.loadtxt(filename)
+    if dtype is not None and array.dtype != dtype:
+        array = array.astype(dtype)
+    return array
+
+def save(filename, array):
+    """
+    Save an array in numpy or text format, according to the extension of filename.
+    """
+    if filename.split(".")[-1] == "npy":
+        np.save(filename, array)
+    else:
+        np.savetxt(filename, array)
+
+def load_experimental(filename):
+    """
+    Load the experimental data, an array of shape (N,2) with the residue number
+    and the value of each observable.
+    Return the residue numbers and the values.
+    """
+    Q = np.asarray(load(filename))
+    return np.asarray(Q[:, 0], dtype=int), Q[:, 1]
+
+def residues(nobs, initial_residue=None, final_residue=None):
+    """
+    Return the columns of the calculated data that correspond to the experimental
+    observables: from initial_residue to final_residue (1-based, both included),
+    or nobs columns from initial_residue.
+    """
+    ini = initial_residue-1 if initial_residue else 0
+    fin = final_residue-1 if final_residue else ini+nobs-1
+    return np.arange(ini, fin+1)
@@ -0,0 +1,71 @@
+"""
+Joint maximum entropy fit of several groups of observables (RDCs, chemical
+shifts...) with a single set of weights.
+
+q and Q hold the groups one after the other (columns of q). Each group has its
+own error sigma2, and the groups of RDCs are rescaled to the experimental
+values by a signed least squares factor, which is negative when the
+experimental and calculated couplings have opposite signs (as PALES output). Rescaling the columns of a group by s is the same as fitting
+Q/s with the error sigma2/s^2 and the lambdas s*lam, so the joint fit is a
+plain gamma fit (see cs.fit), one pass over q per iteration.
+
+The scale factors are not refitted to the re-weighted averages: a larger scale
+always fits as well with flatter weights, so the scale would grow without
+bound. They are fitted to the average of the unweighted ensemble, or given.
+"""
+
+import numpy as np
+
+from . import cs
+from .kernel import qave
+
+
+def _slices(groups):
+    """
+    return the slices of the columns of each group, given the group sizes
+    """
+    bounds = np.cumsum([0] + list(groups))
+    return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+def fit(q, Q, groups, sigma2, scale=None, lam=None, full_output=False, **kwargs):
+    """
+    Optimize the lambdas of all the groups together.
+    Input:
+    q - array of shape (N,M) with the M observables of all the groups (see cs.fit
+      for memory-mapped and blocked q).
+    Q - array of shape (M,) with the experimental observables of all the groups.
+    groups - number of observables of each group, in the order of the columns.
+    sigma2 - error of each group, a float or an array with a value per observable.
+    scale - scale factor of each group: a number, or None to fit it to Q with the
+      unweighted ensemble (least squares, with its sign, for RDCs). Default 1
+      for every group.
+    full_output - if True, also return the dictionary of cs.fit, with qave
+      rescaled, and for each group its scale factor, rmsd and chi2 (groups, a
+      list of dictionaries).
+    Other keyword arguments (method, chunksize, n_jobs, prior) are passed to cs.fit.
+    The lambdas act on the unscaled q, so the weights are w(lam, q).
+    """
+    slices = _slices(groups)
+    if slices[-1].stop != len(Q):
+        raise ValueError("The groups have {} observables and Q {}".format(slices[-1].stop, len(Q)))
+    if scale is None:
+        scale = [1.]*len(slices)
+    if len(sigma2) != len(slices) or len(scale) != len(slices):
+        raise ValueError("sigma2 and scale need a value for each group")
+    sigma2 = np.concatenate([s*np.ones(sl.stop-sl.start) for s, sl in zip(sigma2, slices)])
+    if any(s is None for s in scale):
+        qa = qave(np.zeros(len(Q)), q, kwargs.get('chunksize'), kwargs.get('prior'))
+        scale = [np.dot(Q[sl], qa[sl])/np.dot(qa[sl], qa[sl]) if s is None else s
+                 for s, sl in zip(scale, slices)]
+    s = np.concatenate([f*np.ones(sl.stop-sl.start) for f, sl in zip(scale, slices)])
+    lam, info = cs.fit(q, Q/s, sigma2/s**2, lam=lam, full_output=True, **kwargs)
+    if not full_output:
+        return lam
+    info['qave'] = info['qave']*s
+    info['groups'] = []
+    for f, sl in zip(scale, slices):
+        vec = info['qave'][sl] - Q[sl]
+        with np.errstate(divide='ignore'):
+            chi2 = np.mean(vec**2/sigma2[sl])
+        info['groups'].append({'scale': f, 'rmsd': np.sqrt(np.mean(vec**2)), 'chi2': chi2})
+    return lam, info
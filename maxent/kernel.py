@@ -0,0 +1,309 @@
+"""
+The log-sum-exp kernel shared by all the MaxEnt objectives.
+
+The weights of the structures are w_i = p_i*exp(-q_i*lam)/Z, with a prior p_i
+that is uniform unless a log prior is given. Every quantity is
+computed from a log-sum-exp state that can be evaluated on blocks of q
+(in memory, memory-mapped or streamed), concurrently in threads, and merged
+exactly.
+
+q can be stored in single precision (float32) to halve the memory and the
+bandwidth of the passes: the products with q are then done in single
+precision, while the exponentials, the log-sum-exp states and the sums over
+rows are accumulated in double precision.
+"""
+
+from collections import deque
+import numpy as np
+
+_CHUNK = 65536 #rows per block when streaming a memory-mapped q
+_SUB = 8192 #rows per double precision accumulation of single precision products
+
+
+class Columns:
+    """
+    Some columns of an array of shape (N,M'), possibly memory-mapped, read block
+    by block, so that the array is never copied whole. The kernel streams it
+    like a memory-mapped array; rows are indexed as in an array, and
+    np.asarray copies the columns into memory.
+    """
+    def __init__(self, q, columns):
+        self.q = q
+        self.columns = np.asarray(columns)
+        self.shape = (len(q), len(self.columns))
+        self.dtype = q.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        return np.asarray(self.q[rows])[..., self.columns]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def _blocks(q, chunksize=None):
+    """
+    yield q in blocks of rows.
+    q is either an array of shape (N,M), possibly memory-mapped, some Columns of
+    one, or an iterable of arrays of shape (n,M) that can be traversed more than once.
+    """
+    if isinstance(q, Columns):
+        chunksize = chunksize or _CHUNK
+        for i in range(0, len(q), chunksize):
+            yield q[i:i+chunksize]
+    elif isinstance(q, np.ndarray):
+        if chunksize is None and isinstance(q, np.memmap):
+            chunksize = _CHUNK
+        if chunksize is None:
+            yield q
+        else:
+            for i in range(0, len(q), chunksize):
+                yield np.asarray(q[i:i+chunksize])
+    else:
+        for block in q:
+            if len(block): yield np.asarray(block)
+
+def _qdot(q, v):
+    """
+    return the product of q with v (of shape (M,) or (M,K)) in double
+    precision, computed in the precision of q
+    """
+    if q.dtype == np.float64:
+        return np.dot(q, v)
+    return np.dot(q, np.asarray(v, dtype=q.dtype)).astype(np.float64)
+
+def _tdot(x, q):
+    """
+    return the product of the transpose of x (of shape (n,) or (n,K)) with q.
+    With a single precision q the products are computed in single precision
+    in groups of _SUB rows, whose results are summed in double precision.
+    """
+    if q.dtype == np.float64:
+        return np.dot(x.T, q)
+    x = np.asarray(x, dtype=q.dtype)
+    out = np.zeros(x.shape[1:] + q.shape[1:])
+    for i in range(0, len(q), _SUB):
+        out += np.dot(x[i:i+_SUB].T, q[i:i+_SUB])
+    return out
+
+def _qxq(q, x):
+    """
+    return the sum of the outer products of the rows of q times x (see _tdot).
+    The rows are taken in groups of _SUB, so the products of q with x are never
+    held for the whole of q.
+    """
+    x = np.asarray(x, dtype=q.dtype)
+    out = np.zeros((q.shape[1], q.shape[1]))
+    for i in range(0, len(q), _SUB):
+        block = q[i:i+_SUB]
+        out += np.dot(block.T*x[i:i+_SUB], block)
+    return out
+
+def _precision(q):
+    """
+    return the precision of the averages of q: 0 in double precision, and in
+    single precision a multiple of the rounding error of its typical value
+    (the rms of its first rows)
+    """
+    block = q if isinstance(q, np.ndarray) else next(_blocks(q), None)
+    if block is None or block.dtype != np.float32:
+        return 0.
+    rms = np.sqrt(np.mean(np.square(np.asarray(block[:_SUB]), dtype=np.float64)))
+    return 4*np.finfo(np.float32).eps*rms
+
+def _pblocks(q, chunksize=None, logprior=None):
+    """
+    yield the blocks of q (see _blocks) together with the log prior of their
+    rows, None for a uniform prior.
+    """
+    i = 0
+    for block in _blocks(q, chunksize):
+        yield block, None if logprior is None else logprior[i:i+len(block)]
+        i += len(block)
+
+def _partial(lam, q, logprior=None):
+    """
+    return the log-sum-exp state of a block of q and its shifted exponentials.
+    The state is [max exponent, sum of exps, exps times q, sum of squared exps, rows],
+    with the exps shifted by the max exponent, so large lambdas do not overflow.
+    logprior - log(N*p) of the rows, for a prior p normalized over the N rows of q,
+      added to the exponents. None for a uniform prior.
+    A block whose rows all have a zero prior has the neutral state
+    [-inf, 0, 0, 0, rows], skipped by _merge.
+    """
+    x = _qdot(q, -lam)
+    if logprior is not None: x += logprior
+    return _lse(x, q)
+
+def _lse(x, q):
+    """
+    return the log-sum-exp state of a block of q (see _partial) from the
+    exponents x of its rows, and the shifted exponentials, computed in x.
+    """
+    xmax = x.max()
+    if xmax == -np.inf:
+        return [xmax, 0., np.zeros(q.shape[1]), 0., len(x)], np.zeros(len(x))
+    x -= xmax
+    np.exp(x, out=x)
+    return [xmax, x.sum(), _tdot(x, q), np.dot(x, x), len(x)], x
+
+def _merge(a, b):
+    """
+    merge two log-sum-exp states (see _partial) exactly
+    """
+    if a is None: return b
+    if b[0] == -np.inf: return a[:4] + [a[4] + b[4]]
+    if a[0] == -np.inf: return b[:4] + [a[4] + b[4]]
+    xmax = max(a[0], b[0])
+    fa, fb = np.exp(a[0]-xmax), np.exp(b[0]-xmax)
+    return [xmax, a[1]*fa + b[1]*fb, a[2]*fa + b[2]*fb,
+            a[3]*fa*fa + b[3]*fb*fb, a[4] + b[4]]
+
+def _pmap(func, blocks, pool=None, n_jobs=1):
+    """
+    yield func(block) for each block, in order.
+    With a thread pool the blocks are evaluated concurrently (the numpy kernels
+    release the GIL), keeping at most 2*n_jobs of them in flight.
+    """
+    if pool is None:
+        for block in blocks:
+            yield func(block)
+        return
+    pending = deque()
+    for block in blocks:
+        pending.append(pool.submit(func, block))
+        if len(pending) >= 2*n_jobs:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def _reduce(lam, q, chunksize=None, logprior=None):
+    """
+    return the log-sum-exp state of q, in a single pass over its blocks
+    """
+    state = None
+    for block, lp in _pblocks(q, chunksize, logprior):
+        state = _merge(state, _partial(lam, block, lp)[0])
+    return state
+
+def _logprior(prior):
+    """
+    return log(N*p) for the prior weights of the N rows of q, normalized here,
+    or None for a uniform prior (prior=None)
+    """
+    if prior is None: return None
+    prior = np.asarray(prior, dtype=float)
+    if (prior < 0).any() or not prior.sum() > 0:
+        raise ValueError("The prior weights must be non-negative, and not all zero")
+    with np.errstate(divide='ignore'):
+        return np.log(prior*(len(prior)/prior.sum()))
+
+def _kish(state, logprior=None):
+    """
+    return the Kish effective size of the weights of a log-sum-exp state,
+    relative to that of the prior (the number of rows for a uniform prior)
+    """
+    size = state[4]
+    if logprior is not None:
+        p = np.exp(logprior)
+        size = p.sum()**2/np.dot(p, p)
+    return state[1]**2/state[3]/size
+
+def _logz(state):
+    """
+    return log(mean(exp(-q*lam))) from a log-sum-exp state, or
+    log(sum(p*exp(-q*lam))) with a prior
+    """
+    return state[0] + np.log(state[1]/state[4])
+
+
+def w(lam, q, chunksize=None, out=None, prior=None):
+    """
+    return the weights.
+    out - array or name of a .npy file (memory-mapped) where the weights are written.
+    prior - prior weights of the rows of q (e.g. from enhanced sampling or cluster
+      sizes), not necessarily normalized. Default uniform.
+    """
+    logprior = _logprior(prior)
+    if out is None and chunksize is None and type(q) is np.ndarray:
+        state, x = _partial(lam, q, logprior)
+        x /= state[1]
+        return x
+    state = _reduce(lam, q, chunksize, logprior)
+    lognorm = state[0] + np.log(state[1])
+    if out is None:
+        out = np.empty(state[4])
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', shape=(state[4],))
+    i = 0
+    for block, lp in _pblocks(q, chunksize, logprior):
+        x = _qdot(block, -lam) - lognorm
+        if lp is not None: x += lp
+        out[i:i+len(block)] = np.exp(x)
+        i += len(block)
+    return out
+
+def qave(lam, q, chunksize=None, prior=None):
+    """
+    return the expected data values for a given lambas
+    """
+    state = _reduce(lam, q, chunksize, _logprior(prior))
+    return state[2]/state[1]
+
+
+def n_eff(lam, q, chunksize=None, prior=None):
+    """
+    Return the normalized Kish n_effective size. With a prior, it is relative
+    to the Kish size of the prior.
+    """
+    logprior = _logprior(prior)
+    return _kish(_reduce(lam, q, chunksize, logprior), logprior)
+
+
+
+def _batch_partial(lams, q, logprior=None):
+    """
+    return the log-sum-exp state of a block of q for K lambdas at once, lams of
+    shape (K,M): [max exponents, sums of exps, exps times q, sums of squared exps,
+    rows, exps times the outer products of q], each with a leading axis of size K.
+    The max exponents of a block whose rows all have a zero prior are -inf, and
+    its sums 0.
+    """
+    x = _qdot(q, -lams.T)
+    if logprior is not None: x += logprior[:, None]
+    xmax = x.max(0)
+    x -= np.where(xmax == -np.inf, 0., xmax)
+    np.exp(x, out=x)
+    return [xmax, x.sum(0), _tdot(x, q), np.einsum('nk,nk->k', x, x), len(x), _batch_qxq(q, x)]
+
+def _batch_qxq(q, x):
+    """
+    return the K sums of the outer products of the rows of q times each column
+    of x (n,K), of shape (K,M,M). The rows are taken in groups small enough to
+    stay in cache, and the K sums of a group are one matrix product, so q is
+    read once.
+    """
+    K, M = x.shape[1], q.shape[1]
+    out = np.zeros((M, K*M))
+    rows = max(1, 2**17//(K*M))
+    for i in range(0, len(q), rows):
+        block = q[i:i+rows]
+        xb = np.asarray(x[i:i+rows], dtype=q.dtype)
+        out += np.dot(block.T, (xb[:, :, None]*block[:, None, :]).reshape(len(block), K*M))
+    return out.reshape(M, K, M).transpose(1, 0, 2)
+
+def _batch_merge(a, b):
+    """
+    merge two batched log-sum-exp states (see _batch_partial) exactly
+    """
+    if a is None: return b
+    xmax = np.maximum(a[0], b[0])
+    # Blocks with a zero prior (max exponent -inf) are skipped
+    with np.errstate(invalid='ignore'):
+        fa = np.where(a[0] == -np.inf, 0., np.exp(a[0]-xmax))
+        fb = np.where(b[0] == -np.inf, 0., np.exp(b[0]-xmax))
+    return [xmax, a[1]*fa + b[1]*fb, a[2]*fa[:,None] + b[2]*fb[:,None],
+            a[3]*fa*fa + b[3]*fb*fb, a[4] + b[4],
+            a[5]*fa[:,None,None] + b[5]*fb[:,None,None]]
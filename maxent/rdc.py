@@ -0,0 +1,191 @@
+"""
+Maximum entropy fit of RDCs.
+The calculated RDCs are rescaled to fit the experimental ones (factq), and the
+fit is regularized by k*|lam|^2, with k bracketed to reach a threshold.
+
+The error can be modelled with a threshold below which the fit is not improved,
+or as an error in the experimental data assumed to be normally distributed,
+as described in:
+https://arxiv.org/abs/1801.05247
+"""
+
+import numpy as np
+
+from .kernel import _blocks, _qdot, _tdot, w, qave
+
+
+def factq(qa, Q):
+    """
+    return the scale factor of the calculated RDCs qa that best fits Q
+    """
+    return np.abs(np.dot(Q, qa))/np.dot(qa, qa)
+
+def scaled_qave(lam, q, Q):
+    """
+    return the expected RDCs values for a given lambdas, scaled to fit Q
+    """
+    qa = qave(lam, q)
+    return qa*factq(qa, Q)
+
+def _wdot(wl, q):
+    """
+    return the sum of the rows of q weighted by wl, block by block
+    """
+    out, i = 0., 0
+    for block in _blocks(q):
+        out = out + _tdot(wl[i:i+len(block)], block)
+        i += len(block)
+    return out
+
+def dqave_dot(wl, qa, q, v):
+    """
+    return the product of the gradient of qave (minus the weighted covariance of q)
+    with the vector v, for weights wl and averages qa. Only matrix-vector products
+    over the blocks of q are needed.
+    """
+    out, i = qa*np.dot(qa, v), 0
+    for block in _blocks(q):
+        out = out - _tdot(wl[i:i+len(block)]*_qdot(block, v), block)
+        i += len(block)
+    return out
+
+def grad_fit_rmsd2(lam, q, Q, sigma2, k):
+    """
+    return the gradient of fit_rmsd2 with respect to lam
+    """
+    Qtemp = Q + lam*sigma2
+    wl = w(lam, q)
+    qa = _wdot(wl, q)
+    # gradient of factq
+    qq = np.dot(qa,qa)
+    qQ = np.dot(qa,Qtemp)
+    s = np.sign(qQ)
+    dfactq = s*(dqave_dot(wl, qa, q, Qtemp)+sigma2*qa)*qq-2*np.abs(qQ)*dqave_dot(wl, qa, q, qa)
+    dfactq /= qq*qq
+    #gradient of fit_rmsd2
+    # factor coming from f1
+    factq = np.abs(qQ)/qq
+    vec = qa*factq - Qtemp
+    df1 = 2*(dfactq*np.dot(qa, vec) + factq*dqave_dot(wl, qa, q, vec) - sigma2*vec)
+    # factor coming from f2
+    df2 = 2*k*lam
+    return (df1+df2)/len(Q)
+
+def fit_rmsd2(lam, q, Q, sigma2, k):
+    """
+    Return the f2 function, with the error sigma2 in the experimental data.
+    See the associated article.
+    """
+    qa = qave(lam, q)
+    Qtemp = Q+lam*sigma2
+    vec = qa*factq(qa, Qtemp) - Qtemp
+    f1 = np.dot(vec, vec)
+    f2 = k*np.dot(lam, lam)
+    return (f1+f2)/len(Q)
+
+def grad_fit_rmsd2_threshold(lam, q, Q, thres, k):
+    """
+    return the gradient of fit_rmsd2_threshold with respect to lam
+    """
+    wl = w(lam, q)
+    qa = _wdot(wl, q)
+    # gradient of factq
+    qq = np.dot(qa,qa)
+    qQ = np.dot(qa,Q)
+    s = np.sign(qQ)
+    dfactq = s*dqave_dot(wl, qa, q, Q)*qq-2*np.abs(qQ)*dqave_dot(wl, qa, q, qa)
+    dfactq /= qq*qq
+    #gradient of fit_rmsd2
+    # factor coming from f1
+    factq = np.abs(qQ)/qq
+    vec = qa*factq - Q
+    f1 = np.dot(vec, vec)/len(Q)
+    if f1>thres*thres:
+        df1 = 2*(dfactq*np.dot(qa, vec) + factq*dqave_dot(wl, qa, q, vec))
+    else:
+        df1 = np.zeros_like(lam)
+    # factor coming from f2
+    df2 = 2*k*lam
+    return (df1+df2)/len(Q)
+
+def fit_rmsd2_threshold(lam, q, Q, thres, k):
+    """
+    Return the f2 function, where the fit is not improved below thres.
+    See the associated article.
+    """
+    qa = qave(lam, q)
+    vec = qa*factq(qa, Q) - Q
+    f1 = np.dot(vec, vec)
+    if f1<thres*thres : f1 = thres*thres
+    f2 = k*np.dot(lam, lam)
+    return (f1+f2)/len(Q)
+
+def rmsd(lam, q, Q):
+    """
+    Return the RMSD between experiental and calculated RDCs. The f1 function in
+    the associated article.
+    """
+    vec = scaled_qave(lam, q, Q) - Q
+    return np.sqrt(np.dot(vec, vec)/len(Q))
+
+def bracket_k(solve, lam, k, threshold, maxiter=30, ratio=1.1):
+    """
+    Find the largest k whose fit is below threshold.
+    solve(lam, k) minimizes starting from lam and returns the new lambdas and their fit.
+    k is bracketed by doubling or halving it, and the bracket is then bisected in
+    log(k) until k_high/k_low < ratio. Each minimization starts from the previous
+    lambdas, and at most maxiter minimizations are done.
+    Returns the lambdas and k of the largest k found below threshold.
+    """
+    lam_low = k_low = k_high = None
+    for i in range(maxiter):
+        lam, fit = solve(lam, k)
+        if fit < threshold:
+            lam_low, k_low = lam, k
+        else:
+            k_high = k
+        if k_low is None:
+            k *= 0.5
+        elif k_high is None:
+            k *= 2.0
+        elif k_high/k_low < ratio:
+            break
+        else:
+            k = np.sqrt(k_low*k_high)
+    else:
+        print("k not converged after {} minimizations.".format(maxiter))
+    if k_low is None:
+        return lam, k
+    return lam_low, k_low
+
+def fit(q, Q, sigma2=1.0, k=1e7, lam=None, error='sigma', callback=None):
+    """
+    Optimize the lambdas.
+    Input:
+    q - array of shape (N,M) with the M RDCs of N structures, possibly
+      memory-mapped (see cs.fit).
+    Q - array of shape (M,) with the experimental RDCs.
+    sigma2 - error of the experimental RDCs (error='sigma') or threshold of the
+      rmsd (error='threshold').
+    k - initial regularization constant, bracketed until the rmsd is below sigma2.
+    callback - called as callback(lam, k, rmsd) after each minimization.
+    Returns the lambdas and k.
+    """
+    import scipy.optimize as so
+    if lam is None:
+        lam = np.zeros(len(Q)) #Lambda initialization
+    if error == 'sigma':
+        f, fprime = fit_rmsd2, grad_fit_rmsd2
+    elif error == 'threshold':
+        f, fprime = fit_rmsd2_threshold, grad_fit_rmsd2_threshold
+    else:
+        raise ValueError("error must be 'sigma' or 'threshold'")
+
+    def solve(lam, k):
+        lam = so.fmin_ncg(f, lam, fprime=fprime, args=(q, Q, sigma2, k),
+                          disp=False, epsilon = 1e-10)
+        fit = rmsd(lam, q, Q)
+        if callback is not None: callback(lam, k, fit)
+        return lam, fit
+
+    return bracket_k(solve, lam, k, sigma2)
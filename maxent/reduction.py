@@ -0,0 +1,166 @@
+"""
+Reduction of redundant ensembles before fitting.
+
+Identical or nearly identical structures (rows of q) are collapsed into
+representatives whose multiplicities are used as a prior, the fit runs on the
+representatives and the weights are expanded back to all the structures.
+
+The representative of a group is the mean of its rows, weighted by their
+prior, so the expanded weights (the weight of a representative shared by its
+rows in proportion to their prior) give the same averages as the reduced fit. For any weights of the full ensemble, the
+averages differ from those of the weights summed over each group by at most
+dmax, the largest distance of a row to its representative, so the rmsd
+changes by at most dmax/sqrt(M).
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from .kernel import _CHUNK, _blocks, _logprior, w
+from .cs import _Gamma, _minimize
+
+
+def _group(q, key, chunksize=None):
+    """
+    group the rows of q whose key (computed on each block of rows) is the same.
+    Returns the group of each row (N,) and the index of the first row of each group.
+    """
+    index = {}
+    labels = np.empty(len(q), dtype=np.int64)
+    first = []
+    start = 0
+    for block in _blocks(q, chunksize):
+        keys, rows, inverse = np.unique(key(block), axis=0, return_index=True, return_inverse=True)
+        ids = np.empty(len(keys), dtype=np.int64)
+        for j, k in enumerate(keys):
+            ids[j] = index.setdefault(k.tobytes(), len(index))
+            if ids[j] == len(first): first.append(start + rows[j])
+        labels[start:start+len(block)] = ids[inverse.ravel()]
+        start += len(block)
+    return labels, np.array(first, dtype=np.int64)
+
+def reduce_ensemble(q, tol=0., n_clusters=None, seed=None, chunksize=None, prior=None):
+    """
+    Collapse the identical or nearly identical rows of q into representatives.
+    Input:
+    q - array of shape (N,M), possibly memory-mapped, or kernel.Columns of one.
+      It is read in blocks of rows, except by k-means, which reads it into memory.
+      The representatives keep the dtype of q.
+    tol - rows that round to the same point of a grid of spacing tol in
+      observable space are grouped. With tol=0 only identical rows are grouped.
+    n_clusters - if given, the rows are grouped by k-means (scipy.cluster.vq.kmeans2)
+      into at most n_clusters groups instead.
+    seed - seed of the k-means initialization.
+    chunksize - number of rows of q read per block. Default _CHUNK.
+    prior - prior weights of the rows (N,). The representatives are the means of
+      their groups weighted by the prior (unweighted if its sum is 0). Default uniform.
+    Returns the representatives (K,M), the multiplicity of each one (K,), the
+    group of each row (N,) and dmax, the largest distance of a row to its
+    representative.
+    """
+    dtype = np.result_type(q.dtype, np.float32)
+    chunksize = chunksize or _CHUNK
+    if n_clusters is not None:
+        from scipy.cluster.vq import kmeans2
+        labels = kmeans2(np.asarray(q, dtype=dtype), n_clusters, minit='++', seed=seed)[1]
+        # Drop empty clusters
+        labels = np.unique(labels, return_inverse=True)[1].ravel()
+    elif tol > 0:
+        labels = _group(q, lambda block: np.floor(block/tol + 0.5).astype(np.int64), chunksize)[0]
+    else:
+        # +0. turns -0. into 0., so that equal rows have the same bytes
+        labels, first = _group(q, lambda block: block + dtype.type(0), chunksize)
+        counts = np.bincount(labels)
+        return np.asarray(q[first], dtype=dtype), counts, labels, 0.
+    counts = np.bincount(labels)
+    # Average the rows of each group
+    sums = np.zeros((len(counts), q.shape[1]))
+    psums = None if prior is None else np.zeros_like(sums)
+    start = 0
+    for block in _blocks(q, chunksize):
+        groups, size = np.unique(labels[start:start+len(block)], return_counts=True)
+        order = np.argsort(labels[start:start+len(block)], kind='stable')
+        starts = np.r_[0, np.cumsum(size)[:-1]]
+        block = block[order].astype(float)
+        sums[groups] += np.add.reduceat(block, starts)
+        if prior is not None:
+            p = prior[start:start+len(block)][order]
+            psums[groups] += np.add.reduceat(block*p[:, None], starts)
+        start += len(block)
+    reps = sums/counts[:, None]
+    if prior is not None:
+        mass = np.bincount(labels, weights=prior, minlength=len(counts))
+        weighted = mass > 0
+        reps[weighted] = psums[weighted]/mass[weighted, None]
+    reps = reps.astype(dtype)
+    dmax = 0.
+    start = 0
+    for block in _blocks(q, chunksize):
+        d = block - reps[labels[start:start+len(block)]].astype(float)
+        dmax = max(dmax, np.sqrt(np.einsum('ij,ij->i', d, d).max()))
+        start += len(block)
+    return reps, counts, labels, dmax
+
+def expand(w, counts, labels):
+    """
+    return the weights of all the rows from the weights w of the representatives,
+    shared evenly among the rows of each group (counts is the size of each group,
+    or its total prior to share the weights in proportion to the prior)
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, w/counts, 0.)[labels]
+
+def fit(q, Q, sigma2, tol=0., n_clusters=None, lam=None, method='BFGS', full_output=False,
+        seed=None, prior=None, chunksize=None, n_jobs=None):
+    """
+    Optimize the lambdas of the reduced ensemble and expand its weights.
+    Input:
+    q, Q, sigma2, lam, method - as in cs.fit, with q an array of shape (N,M),
+      possibly memory-mapped, or kernel.Columns of one.
+    tol, n_clusters, seed - how the rows of q are grouped (see reduce_ensemble).
+    chunksize - number of rows of q read per block, and of representatives per
+      block of the fit (see cs.fit).
+    n_jobs - number of threads evaluating blocks of representatives (see cs.fit).
+    prior - prior weights of the N rows (see cs.fit). A representative is the mean
+      of its rows weighted by their prior, its prior is the sum of theirs, and its
+      weight is shared among them in proportion to their prior. Default uniform.
+    full_output - if True, also return a dictionary with the number of
+      iterations (nit) and passes over the representatives (npass), the
+      convergence status, gamma, qave, the rmsd, the n_eff of the expanded
+      weights (relative to that of the prior), the number of representatives (n_reduced) and rmsd_bound, the
+      largest change of the rmsd due to the reduction (dmax/sqrt(M)).
+    Returns the lambdas of the representatives and the weights of the N rows of q.
+    """
+    if prior is not None: prior = np.asarray(prior, dtype=float)
+    reps, counts, labels, dmax = reduce_ensemble(q, tol, n_clusters, seed, chunksize, prior)
+    if lam is None:
+        lam = np.zeros(len(Q)) #Lambda initialization
+    sigma2 = sigma2*np.ones_like(lam)
+    # The multiplicities are the prior of the representatives
+    mass = counts if prior is None else np.bincount(labels, weights=prior, minlength=len(counts))
+    if not n_jobs or n_jobs == 1:
+        fun = _Gamma(reps, Q, sigma2, chunksize, logprior=_logprior(mass))
+        result = _minimize(fun, lam, method)
+        fun.evaluate(result.x)
+    else:
+        with ThreadPoolExecutor(n_jobs) as pool:
+            fun = _Gamma(reps, Q, sigma2, chunksize or -(-len(reps)//n_jobs), pool, n_jobs,
+                         _logprior(mass))
+            result = _minimize(fun, lam, method)
+            fun.evaluate(result.x)
+    if not result.success: print("Minimisation not converged!")
+    weights = expand(fun.w if fun.w is not None else w(result.x, reps, chunksize, prior=mass),
+                     mass, labels)
+    size = len(weights)
+    if prior is not None:
+        weights *= prior
+        size = np.sum(prior)**2/np.dot(prior, prior)
+    if full_output:
+        vec = fun.qave - Q
+        info = {'nit': result.nit, 'npass': fun.npass,
+                'success': result.success, 'message': result.message,
+                'gamma': fun.gamma, 'qave': fun.qave, 'rmsd': np.sqrt(np.mean(vec**2)),
+                'n_eff': 1/np.dot(weights, weights)/size,
+                'n_reduced': len(reps), 'rmsd_bound': dmax/np.sqrt(len(Q))}
+        return result.x, weights, info
+    return result.x, weights
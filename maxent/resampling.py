@@ -0,0 +1,172 @@
+"""
+Bootstrap and jackknife uncertainties of the lambdas, weights, averages and n_eff.
+
+Replicates are never materialized as copies of q. Resampling the structures
+changes their prior: a bootstrap replicate weights each structure by the
+number of times it is drawn, and a jackknife replicate gives a prior of 0 to
+a group of structures. Resampling the observables changes their errors:
+drawing an observable c times is the same as fitting it once with the error
+sigma2/c, and an observable that is not drawn (or is left out by the
+jackknife) is masked with its lambda fixed to 0.
+
+The replicates run in batches on a pool of processes sharing q (see
+validation), each starting from the lambdas of the full data, and their
+results are accumulated on the fly (Welford), so only means and variances
+are kept.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .kernel import _logprior, w
+from .cs import _Gamma, _minimize, fit
+from .validation import _Masked, _share, _open, _release
+
+
+class _Welford:
+    """
+    running mean and sum of squared deviations of arrays of a fixed shape
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.m2 = 0.
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta/self.n
+        self.m2 = self.m2 + delta*(x - self.mean)
+
+    def merge(self, other):
+        """
+        merge the accumulation of another _Welford (Chan et al.)
+        """
+        if other.n == 0: return
+        n = self.n + other.n
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.n/n
+        self.m2 = self.m2 + other.m2 + delta**2*self.n*other.n/n
+        self.n = n
+
+
+def _replicate(kind, method, index, seed, N, M, n_groups):
+    """
+    return the prior factors of the structures (N,) and the counts of the
+    observables (M,) of a replicate; None for the ones that are not resampled
+    """
+    if method == 'bootstrap':
+        rng = np.random.default_rng([seed, index])
+        n = N if kind == 'structures' else M
+        counts = rng.multinomial(n, np.ones(n)/n).astype(float)
+    else:
+        n = N if kind == 'structures' else M
+        counts = np.ones(n)
+        counts[np.array_split(np.arange(n), n_groups)[index]] = 0.
+    return (counts, None) if kind == 'structures' else (None, counts)
+
+def _batch(spec, Q, sigma2, lam0, kind, method, indices, seed, n_groups, minimize,
+           chunksize, prior, weights):
+    """
+    fit the replicates of indices and return the accumulated lambdas, averages,
+    n_eff and, if weights, weights
+    """
+    q, prior = _open(spec), _open(prior)
+    N, M = q.shape
+    acc = {key: _Welford() for key in ('lam', 'qave', 'n_eff', 'w')}
+    for index in indices:
+        factor, counts = _replicate(kind, method, index, seed, N, M, n_groups)
+        p = factor if prior is None else (prior if factor is None else prior*factor)
+        logprior = _logprior(p)
+        active = np.ones(M, bool) if counts is None else counts > 0
+        s2 = sigma2 if counts is None else sigma2/np.maximum(counts, 1)
+        fun = _Gamma(q, Q, s2, chunksize, logprior=logprior)
+        masked = _Masked(fun, active)
+        lam = _minimize(masked, lam0[active], minimize).x
+        fun.evaluate(masked._full(lam))
+        acc['lam'].add(fun.lam)
+        acc['qave'].add(fun.qave)
+        acc['n_eff'].add(fun.n_eff)
+        if weights:
+            acc['w'].add(fun.w if fun.w is not None else w(fun.lam, q, chunksize, prior=p))
+    return acc
+
+def _resample(q, Q, sigma2, kind, method, n, seed, n_groups, minimize, n_jobs, chunksize,
+              prior, weights):
+    """
+    run n replicates, in batches on n_jobs processes, and merge their accumulations
+    """
+    if kind not in ('structures', 'observables'):
+        raise ValueError("kind must be 'structures' or 'observables'")
+    sigma2 = sigma2*np.ones(len(Q))
+    lam0 = fit(q, Q, sigma2, method=minimize, chunksize=chunksize, prior=prior)
+    args = (Q, sigma2, lam0, kind, method)
+    options = (seed, n_groups, minimize, chunksize, prior, weights)
+    if not n_jobs or n_jobs == 1:
+        parts = [_batch(q, *args, range(n), *options)]
+    else:
+        batches = np.array_split(np.arange(n), min(n, 4*n_jobs))
+        # q and the prior are shared with the workers instead of pickled for each batch
+        spec, shm = _share(q)
+        pspec, pshm = (None, None) if prior is None else _share(np.asarray(prior, dtype=float))
+        options = (seed, n_groups, minimize, chunksize, pspec, weights)
+        try:
+            with ProcessPoolExecutor(n_jobs) as pool:
+                futures = [pool.submit(_batch, spec, *args, batch, *options) for batch in batches]
+                parts = [future.result() for future in futures]
+        finally:
+            _release(shm)
+            _release(pshm)
+    acc = parts[0]
+    for part in parts[1:]:
+        for key in acc:
+            acc[key].merge(part[key])
+    return acc
+
+def bootstrap(q, Q, sigma2, n_boot=100, kind='structures', seed=None, method='trust-exact',
+              n_jobs=None, chunksize=None, prior=None, weights=True):
+    """
+    Bootstrap the structures or the observables.
+    Input:
+    q, Q, sigma2 - as in cs.fit.
+    n_boot - number of bootstrap replicates.
+    kind - 'structures' or 'observables', what is resampled with replacement.
+    seed - seed of the replicates; replicate i is the same whatever n_jobs.
+    method - scipy.optimize.minimize method of each fit (see cs.fit).
+    n_jobs - number of processes running the replicates. Default 1 (in this process).
+    chunksize, prior - as in cs.fit.
+    weights - whether to accumulate the weights of the structures (N values).
+    Returns a dictionary with the mean and standard deviation of lam, qave,
+    n_eff and w (lam_std...), and the number of replicates n.
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    acc = _resample(q, Q, sigma2, kind, 'bootstrap', n_boot, seed, None, method, n_jobs,
+                    chunksize, prior, weights)
+    result = {'n': n_boot}
+    for key, value in acc.items():
+        if key == 'w' and not weights: continue
+        result[key] = value.mean
+        result[key + '_std'] = np.sqrt(value.m2/(value.n - 1))
+    return result
+
+def jackknife(q, Q, sigma2, n_groups=None, kind='structures', method='trust-exact',
+              n_jobs=None, chunksize=None, prior=None, weights=True):
+    """
+    Jackknife the structures or the observables: each replicate leaves out one
+    of n_groups contiguous groups of them (default one observable, or 20
+    groups of structures).
+    The other inputs are as in bootstrap. Returns a dictionary with the mean
+    and the jackknife standard error of lam, qave, n_eff and w (lam_std...),
+    and the number of replicates n.
+    """
+    n = len(Q) if kind == 'observables' else q.shape[0]
+    n_groups = min(n_groups or (n if kind == 'observables' else 20), n)
+    acc = _resample(q, Q, sigma2, kind, 'jackknife', n_groups, None, n_groups, method, n_jobs,
+                    chunksize, prior, weights)
+    result = {'n': n_groups}
+    for key, value in acc.items():
+        if key == 'w' and not weights: continue
+        result[key] = value.mean
+        result[key + '_std'] = np.sqrt(value.m2*(n_groups - 1)/n_groups)
+    return result
@@ -0,0 +1,73 @@
+"""
+Sparse storage of the weights of large ensembles.
+
+After a fit most of the weight is usually held by a small fraction of the
+structures. The support is the smallest set of structures holding a given
+fraction of the weight; its indices and weights are stored in a .npz file,
+optionally with the names of the structures (Processed_PDB.dat of RunPales),
+and the fit can be repeated on the support alone.
+"""
+
+import numpy as np
+
+from . import cs
+
+
+def support(w, mass=0.99):
+    """
+    return the indices, by decreasing weight, and the weights of the fewest
+    structures whose weights add up to mass (a fraction of the total)
+    """
+    w = np.asarray(w)
+    order = np.argsort(w)[::-1]
+    cumulative = np.cumsum(w[order])
+    k = min(np.searchsorted(cumulative, mass*cumulative[-1]) + 1, len(w))
+    return order[:k], w[order[:k]]
+
+def read_names(filename):
+    """
+    return the names of the structures, one per line (Processed_PDB.dat)
+    """
+    with open(filename) as namefile:
+        return np.array([line.strip() for line in namefile if line.strip()])
+
+def save(filename, indices, weights, n, names=None):
+    """
+    Save a sparse set of weights of n structures in a .npz file, with the
+    names of all the structures (names is then mapped to the indices).
+    """
+    arrays = {'index': np.asarray(indices), 'weight': np.asarray(weights), 'n': n}
+    if names is not None:
+        arrays['name'] = np.asarray(names)[indices]
+    np.savez(filename, **arrays)
+
+def load(filename):
+    """
+    return the indices, weights, number of structures and names (or None) of a
+    sparse set of weights saved with save
+    """
+    with np.load(filename) as data:
+        names = data['name'] if 'name' in data else None
+        return data['index'], data['weight'], int(data['n']), names
+
+def dense(indices, weights, n):
+    """
+    return the full vector of the weights of n structures
+    """
+    w = np.zeros(n)
+    w[indices] = weights
+    return w
+
+def refit(q, Q, sigma2, indices, prior=None, **kwargs):
+    """
+    Optimize the lambdas on the structures of indices only.
+    The rows are read in order, so a memory-mapped q is read sequentially.
+    Other keyword arguments are passed to cs.fit (full_output is not supported).
+    Returns the lambdas and the indices (sorted) and weights of the support.
+    """
+    from .kernel import w
+    indices = np.sort(indices)
+    qs = np.asarray(q[indices])
+    ps = None if prior is None else np.asarray(prior)[indices]
+    lam = cs.fit(qs, Q, sigma2, prior=ps, **kwargs)
+    return lam, indices, w(lam, qs, prior=ps)
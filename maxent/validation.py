@@ -0,0 +1,172 @@
+"""
+Cross-validation of sigma2 over the observables.
+
+The observables are split into folds; each fold is held out in turn, the
+lambdas are fitted to the rest for every sigma2 and the rmsd of the held-out
+observables is scored. The held-out observables are masked rather than cut
+out of q: their lambdas are fixed to 0, so q is never copied and the held-out
+averages come from the same pass over q as the fit.
+
+The folds run on a pool of processes that share q: a memory-mapped q is
+re-opened by each worker, and an in-memory q is copied once to shared
+memory. The sigma2 points of each fold are fitted in order, from the largest
+to the smallest, each starting from the lambdas of the previous one.
+"""
+
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .kernel import Columns, _logprior
+from .cs import _Gamma, _minimize
+
+
+class _Masked:
+    """
+    gamma (see cs._Gamma) as a function of the lambdas of the active observables,
+    with the lambdas of the others fixed to 0
+    """
+    def __init__(self, fun, active):
+        self.fun = fun
+        self.active = active
+        self.lam = np.zeros(len(active))
+        self.eps = fun.eps
+
+    def _full(self, lam):
+        self.lam[self.active] = lam
+        return self.lam
+
+    def __call__(self, lam):
+        gamma, grad = self.fun(self._full(lam))
+        return gamma, grad[self.active]
+
+    def hess(self, lam):
+        return self.fun.hess(self._full(lam))[np.ix_(self.active, self.active)]
+
+    def hessp(self, lam, p):
+        full = np.zeros(len(self.active))
+        full[self.active] = p
+        return self.fun.hessp(self._full(lam), full)[self.active]
+
+
+def _share(q):
+    """
+    return a description of q that worker processes can open without copying
+    it, and the shared memory block to release afterwards (or None).
+    The columns of a memory-mapped array (see kernel.Columns) are selected by
+    the workers; those of an in-memory array are copied to shared memory.
+    """
+    columns = None
+    if isinstance(q, Columns) and isinstance(q.q, np.memmap) and isinstance(q.q.base, mmap.mmap):
+        q, columns = q.q, q.columns
+    if isinstance(q, np.memmap) and isinstance(q.base, mmap.mmap):
+        return ('memmap', q.filename, q.offset, q.shape, q.dtype.str, columns), None
+    from multiprocessing import shared_memory
+    q = np.asarray(q)
+    shm = shared_memory.SharedMemory(create=True, size=max(q.nbytes, 1))
+    np.ndarray(q.shape, q.dtype, buffer=shm.buf)[...] = q
+    return ('shm', shm.name, 0, q.shape, q.dtype.str, None), shm
+
+_attached = {}
+
+def _open(spec):
+    """
+    return the array described by spec (see _share), read only
+    """
+    if not isinstance(spec, tuple):
+        return spec
+    kind, name, offset, shape, dtype, columns = spec
+    if kind == 'memmap':
+        q = np.memmap(name, dtype=dtype, mode='r', offset=offset, shape=shape)
+        return q if columns is None else Columns(q, columns)
+    if name not in _attached:
+        # The workers share the resource tracker of the process that created
+        # the block, which unlinks it
+        from multiprocessing import shared_memory
+        _attached[name] = shared_memory.SharedMemory(name=name)
+    q = np.ndarray(shape, dtype, buffer=_attached[name].buf)
+    q.flags.writeable = False
+    return q
+
+def _release(shm):
+    """
+    release a shared memory block returned by _share
+    """
+    if shm is not None:
+        shm.close()
+        shm.unlink()
+
+def _chain(spec, Q, sigma2s, held_out, method, chunksize, prior):
+    """
+    fit the observables not held out for each sigma2 in turn, each fit starting
+    from the lambdas of the previous one. Return the held-out and training
+    squared errors (K,M) and the number of passes over q.
+    """
+    q, prior = _open(spec), _open(prior)
+    active = np.ones(len(Q), bool)
+    active[held_out] = False
+    lam = np.zeros(active.sum())
+    logprior = _logprior(prior)
+    errors, npass = [], 0
+    for sigma2 in sigma2s:
+        fun = _Gamma(q, Q, sigma2, chunksize, logprior=logprior)
+        masked = _Masked(fun, active)
+        lam = _minimize(masked, lam, method).x
+        fun.evaluate(masked._full(lam))
+        errors.append((fun.qave - Q)**2)
+        npass += fun.npass
+    return np.array(errors), npass
+
+def cross_validate(q, Q, sigma2_list, n_folds=5, method='trust-exact', seed=None,
+                   n_jobs=None, chunksize=None, prior=None):
+    """
+    Cross-validate sigma2 by holding out folds of observables.
+    Input:
+    q - array of shape (N,M), possibly memory-mapped (see load).
+    Q - array of shape (M,) with the experimental observables.
+    sigma2_list - K values of sigma2, each a float or an array of shape (M,).
+    n_folds - number of folds of observables, at most M (leave one out).
+    method - scipy.optimize.minimize method of each fit (see cs.fit).
+    seed - seed of the random split of the observables into folds.
+    n_jobs - number of processes running the folds. Default 1 (in this process).
+    chunksize, prior - as in cs.fit.
+    Returns a dictionary with sigma2 (K,M), the cross-validated rmsd of each
+    sigma2 over all the held-out observables (cv_rmsd) and for each fold
+    (fold_rmsd, (n_folds,K)), the rmsd of the training observables (train_rmsd),
+    the selected sigma2 (sigma2_opt, the smallest cv_rmsd), the folds and the
+    number of passes over q (npass).
+    """
+    M = len(Q)
+    sigma2 = np.array([s*np.ones(M) for s in sigma2_list])
+    # Largest errors first, so that each fit starts from a smoother neighbour
+    order = np.argsort(-sigma2.mean(1), kind='stable')
+    folds = np.array_split(np.random.default_rng(seed).permutation(M), min(n_folds, M))
+    args = (Q, sigma2[order])
+    if not n_jobs or n_jobs == 1:
+        results = [_chain(q, *args, fold, method, chunksize, prior) for fold in folds]
+    else:
+        # q and the prior are shared with the workers instead of pickled for each fold
+        spec, shm = _share(q)
+        pspec, pshm = (None, None) if prior is None else _share(np.asarray(prior, dtype=float))
+        try:
+            with ProcessPoolExecutor(min(n_jobs, len(folds))) as pool:
+                results = list(pool.map(_chain, [spec]*len(folds), *zip(*[args]*len(folds)),
+                                        folds, [method]*len(folds), [chunksize]*len(folds),
+                                        [pspec]*len(folds)))
+        finally:
+            _release(shm)
+            _release(pshm)
+    held = np.zeros((len(sigma2), M))
+    train = np.zeros((len(folds), len(sigma2)))
+    fold_rmsd = np.zeros((len(folds), len(sigma2)))
+    for i, (fold, (errors, npass)) in enumerate(zip(folds, results)):
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        errors = errors[inverse]
+        held[:, fold] = errors[:, fold]
+        fold_rmsd[i] = np.sqrt(errors[:, fold].mean(1))
+        train[i] = np.sqrt(np.delete(errors, fold, axis=1).mean(1))
+    cv_rmsd = np.sqrt(held.mean(1))
+    return {'sigma2': sigma2, 'cv_rmsd': cv_rmsd, 'fold_rmsd': fold_rmsd,
+            'train_rmsd': train.mean(0), 'sigma2_opt': sigma2[np.argmin(cv_rmsd)],
+            'folds': folds, 'npass': sum(r[1] for r in results)}
@@ -0,0 +1,86 @@
+"""
+Checks of the gamma fits of maxent.cs.
+"""
+
+import os
+import numpy as np
+
+import maxent
+from maxent import cs, io
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_fit_many():
+    q, Q = _data()
+    result = cs.fit_many(q, Q, [0.1, 1.])
+    assert result['success'].all()
+    for lam, sigma2 in zip(result['lam'], [0.1, 1.]):
+        assert np.allclose(lam, cs.fit(q, Q, sigma2, method='trust-exact'), rtol=1e-6, atol=1e-10)
+
+def test_fit_many_maxiter():
+    q, Q = _data()
+    result = cs.fit_many(q, Q, [0.1, 1.], maxiter=0)
+    assert result['nit'] == 0 and result['npass'] == 1
+    assert not result['success'].any()
+    assert np.array_equal(result['lam'], np.zeros((2, len(Q))))
+
+def _baseline_w(lam, q):
+    # MaxEntMod.w of the original scripts
+    delta = q.mean(0)
+    w = np.exp(np.dot(-q+delta, lam))
+    return w/w.sum()
+
+def _baseline_gamma(lam, q, Q, sigma2):
+    # MaxEntMod._gamma of the original scripts
+    return np.log(np.exp(-np.dot(q-Q, lam)).mean()) + 0.5*np.dot(sigma2, lam**2)
+
+def test_baseline():
+    q, Q = _data()
+    sigma2 = 0.5*np.ones(len(Q))
+    lam = np.random.default_rng(0).normal(scale=0.5, size=len(Q))
+    w = _baseline_w(lam, q)
+    assert np.allclose(cs.w(lam, q), w, rtol=1e-10, atol=0)
+    assert np.allclose(cs.qave(lam, q), np.dot(w, q), rtol=1e-10)
+    assert np.isclose(maxent.n_eff(lam, q), 1/np.sum(w**2)/len(q), rtol=1e-10)
+    assert np.isclose(cs._gamma(lam, q, Q, sigma2), _baseline_gamma(lam, q, Q, sigma2), rtol=1e-10)
+    # The gradient of the original scripts vanishes at the fitted lambdas
+    lam = cs.fit(q, Q, sigma2, method='trust-exact')
+    grad = Q - np.dot(_baseline_w(lam, q), q) + lam*sigma2
+    assert np.abs(grad).max() < 1e-8
+
+def test_prior_counts():
+    # Integer prior weights are the same as repeated rows
+    q, Q = _data()
+    counts = np.random.default_rng(0).integers(0, 4, len(q))
+    lam = cs.fit(q, Q, 0.5, method='trust-exact', prior=counts)
+    lam_rep = cs.fit(np.repeat(q, counts, axis=0), Q, 0.5, method='trust-exact')
+    assert np.allclose(lam, lam_rep, rtol=1e-6, atol=1e-10)
+    w = cs.w(lam, q, prior=counts)
+    assert np.allclose(np.repeat(w/np.maximum(counts, 1), counts), cs.w(lam_rep, np.repeat(q, counts, axis=0)))
+
+def test_float32():
+    q, Q = _data()
+    for method in ('trust-exact', 'BFGS'):
+        lam, info = cs.fit(q, Q, 0.5, method=method, full_output=True)
+        lam32, info32 = cs.fit(q.astype(np.float32), Q, 0.5, method=method, full_output=True)
+        assert info32['success']
+        assert np.allclose(lam32, lam, rtol=1e-4, atol=1e-8)
+
+def test_cli_baseline(tmp_path, capsys):
+    # maxent cs saves the weights of the BFGS fit of the original scripts
+    import scipy.optimize as so
+    from maxent.cli import main
+    q, Q = _data()
+    sigma2 = 0.5*np.ones(len(Q))
+    grad = lambda lam, q, Q, sigma2: Q - np.dot(_baseline_w(lam, q), q) + lam*sigma2
+    lam = so.minimize(_baseline_gamma, np.zeros(len(Q)), jac=grad, args=(q, Q, sigma2)).x
+    main(['cs', os.path.join(DATA, 'calculated.npy'), os.path.join(DATA, 'experimental.dat'),
+          '--sigma2', '0.5', '--no-plot', '-sw', str(tmp_path/'w.npy'), '-s', str(tmp_path/'q.npy')])
+    assert np.allclose(np.load(tmp_path/'w.npy'), _baseline_w(lam, q), rtol=1e-3, atol=1e-12)
+    assert np.allclose(np.load(tmp_path/'q.npy')[:, 1], np.dot(_baseline_w(lam, q), q), rtol=1e-4)
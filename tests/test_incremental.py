@@ -0,0 +1,35 @@
+"""
+Checks of the incremental fit against a full fit of the grown ensemble.
+"""
+
+import os
+import numpy as np
+
+from maxent import cs, io
+from maxent.incremental import IncrementalFit
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_append():
+    q, Q = _data()
+    fit = IncrementalFit(Q, 0.5, chunksize=1000)
+    fit.append(q[:5000])
+    lam = fit.append(q[5000:])
+    full = cs.fit(q, Q, 0.5, method='trust-exact')
+    assert len(fit) == len(q)
+    assert np.allclose(lam, full, rtol=1e-5, atol=1e-7)
+    assert np.allclose(fit.w(), cs.w(full, q), rtol=1e-4, atol=1e-14)
+
+def test_append_prior():
+    q, Q = _data()
+    prior = np.random.default_rng(0).random(len(q))
+    fit = IncrementalFit(Q, 0.5, chunksize=1000)
+    fit.append(q[:3000], prior[:3000])
+    lam = fit.append(q[3000:], prior[3000:])
+    assert np.allclose(lam, cs.fit(q, Q, 0.5, method='trust-exact', prior=prior), rtol=1e-5, atol=1e-7)
@@ -0,0 +1,35 @@
+"""
+Checks of the joint fit against the cs fit of the same observables.
+"""
+
+import os
+import numpy as np
+
+from maxent import cs, io, joint
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_fixed_scale():
+    q, Q = _data()
+    lam = cs.fit(q, Q, 0.5, method='trust-exact')
+    lam_joint = joint.fit(q, Q, [10, len(Q)-10], [0.5, 0.5], method='trust-exact')
+    assert np.allclose(lam, lam_joint, rtol=1e-6, atol=1e-10)
+
+def test_opposite_sign():
+    # PALES couplings have the opposite sign of the calculated ones: the fitted
+    # scale is negative and the fit is as good as that of the same sign data
+    q, Q = _data()
+    lam, info = joint.fit(q, Q, [len(Q)], [0.5], [None], full_output=True, method='trust-exact')
+    lam_neg, info_neg = joint.fit(q, -Q, [len(Q)], [0.5], [None], full_output=True,
+                                  method='trust-exact')
+    assert info['groups'][0]['scale'] > 0
+    assert np.isclose(info_neg['groups'][0]['scale'], -info['groups'][0]['scale'])
+    assert np.isclose(info_neg['groups'][0]['rmsd'], info['groups'][0]['rmsd'])
+    assert np.allclose(lam_neg, lam)
+    assert np.allclose(info_neg['qave'], -info['qave'])
@@ -0,0 +1,44 @@
+"""
+Checks of the RDC objective and its gradients against the original scripts.
+"""
+
+import os
+import numpy as np
+import scipy.optimize as so
+
+from maxent import io, rdc
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def _baseline_fit_rmsd2(lam, q, Q, sigma2, k):
+    # fit_rmsd2 of MaxEnt-sigma.py, which fitted q = -calculated to Q
+    qa = np.dot(np.exp(np.dot(-q, lam)), q)
+    Qtemp = Q + lam*sigma2
+    factq = np.abs(np.dot(Qtemp, qa))/np.dot(qa, qa)
+    vec = qa*factq - Qtemp
+    return (np.dot(vec, vec) + k*np.dot(lam, lam))/len(Q)
+
+def test_baseline():
+    # maxent rdc fits the calculated q to -Q with lambdas of the opposite sign
+    q, Q = _data()
+    lam = np.random.default_rng(0).normal(scale=0.1, size=len(Q))
+    for sigma2, k in ((0.5, 1e4), (0., 1e2)):
+        assert np.isclose(rdc.fit_rmsd2(-lam, q, -Q, sigma2, k), _baseline_fit_rmsd2(lam, -q, Q, sigma2, k),
+                          rtol=1e-10)
+
+def test_gradients():
+    # The matrix-vector gradients against finite differences
+    q, Q = _data()
+    lam = np.random.default_rng(1).normal(scale=0.1, size=len(Q))
+    sigma2 = np.linspace(0.1, 1, len(Q))
+    for f, fprime, args in ((rdc.fit_rmsd2, rdc.grad_fit_rmsd2, (q, Q, sigma2, 10.)),
+                            (rdc.fit_rmsd2_threshold, rdc.grad_fit_rmsd2_threshold, (q, Q, 0.01, 10.))):
+        grad = fprime(lam, *args)
+        approx = so.approx_fprime(lam, f, 1e-7, *args)
+        assert np.allclose(grad, approx, rtol=1e-4, atol=1e-6*np.abs(grad).max())
@@ -0,0 +1,36 @@
+"""
+Checks of the reduced fits against the fits of the full ensemble.
+"""
+
+import os
+import numpy as np
+
+from maxent import cs, io, reduction
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_identical_rows():
+    # Duplicated rows are fitted once with their multiplicity
+    q, Q = _data()
+    q = np.concatenate([q, q[:3000], q[:500]])
+    lam = cs.fit(q, Q, 0.5, method='trust-exact')
+    lam_red, weights, info = reduction.fit(q, Q, 0.5, method='trust-exact', full_output=True)
+    assert info['n_reduced'] == 8000 and info['rmsd_bound'] == 0.
+    assert np.allclose(lam_red, lam, rtol=1e-6, atol=1e-10)
+    assert np.allclose(weights, cs.w(lam, q), rtol=1e-6, atol=1e-14)
+
+def test_prior_averages():
+    # The reported averages are those of the expanded weights
+    q, Q = _data()
+    prior = np.random.default_rng(0).random(len(q))
+    prior[:50] = 0
+    lam, weights, info = reduction.fit(q, Q, 0.5, n_clusters=50, seed=1, method='trust-exact',
+                                       full_output=True, prior=prior)
+    assert np.all(np.isfinite(weights)) and np.isclose(weights.sum(), 1)
+    assert np.allclose(np.dot(weights, q), info['qave'], rtol=0, atol=1e-10)
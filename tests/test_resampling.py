@@ -0,0 +1,33 @@
+"""
+Regression checks of the jackknife over structures, whose left-out groups have
+a zero prior and can cover whole blocks of q.
+"""
+
+import os
+import numpy as np
+
+from maxent import io, kernel, resampling
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_zero_prior_block():
+    q, Q = _data()
+    prior = np.ones(len(q))
+    prior[:2000] = 0
+    lam = np.full(len(Q), 0.01)
+    w = kernel.w(lam, q, chunksize=1000, prior=prior)
+    assert np.isfinite(w).all()
+    assert np.allclose(w[2000:], kernel.w(lam, q[2000:]))
+
+def test_jackknife_blocks():
+    q, Q = _data()
+    blocks = resampling.jackknife(q, Q, 0.5, n_groups=4, chunksize=1000)
+    whole = resampling.jackknife(q, Q, 0.5, n_groups=4)
+    for key in ('lam', 'lam_std', 'n_eff'):
+        assert np.allclose(blocks[key], whole[key])
@@ -0,0 +1,53 @@
+"""
+Checks of the native RDC backends of RunPales-1.0.py. The steric model is
+checked against a Monte Carlo simulation of the same planar walls; it has no
+reference pales output yet.
+"""
+
+import os
+import importlib.util
+import numpy as np
+
+SCRIPT = os.path.join(os.path.dirname(__file__), os.pardir, 'RunPales-1.0.py')
+spec = importlib.util.spec_from_file_location('runpales', SCRIPT)
+runpales = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(runpales)
+
+
+def _rod(n=20, length=30.):
+    """
+    return the atoms of a bent rod along x, centered at the origin
+    """
+    x = np.linspace(-length/2, length/2, n)
+    coords = np.c_[x, 0.1*x**2/length, 0.05*x]
+    return coords - coords.mean(0)
+
+def test_steric_monte_carlo():
+    # Random wall normals and positions of the center between walls 80 A apart,
+    # kept when every atom lies between them
+    coords = _rod()
+    wv = 0.5
+    rng = np.random.default_rng(0)
+    n = rng.normal(size=(400000, 3))
+    n /= np.linalg.norm(n, axis=1)[:, None]
+    proj = np.dot(n, coords.T)
+    center = rng.uniform(0, 40./wv, len(n))
+    inside = (center + proj.min(1) >= 0) & (center + proj.max(1) <= 40./wv)
+    u = n[inside]
+    p2 = 1.5*np.einsum('ki,kj->ij', u, u)/len(u) - 0.5*np.eye(3)
+    order = runpales.steric_order(coords[None], wv, runpales.sphere(4000))[0]
+    assert np.allclose(order, -0.5*p2, atol=1e-3)
+    assert np.isclose(np.trace(order), 0, atol=1e-12)
+
+def test_svd_backend():
+    # RDCs of a known alignment tensor are reproduced by the tensor fitted to them
+    rng = np.random.default_rng(1)
+    coords = rng.normal(scale=5., size=(1, 40, 3))
+    coords[0, 20:] = coords[0, :20] + rng.normal(size=(20, 3))/np.sqrt(3)
+    pairs = [((i, 'N'), (i, 'H')) for i in range(20)]
+    index = (np.arange(20), np.arange(20, 40))
+    vectors = coords[:, index[1]] - coords[:, index[0]]
+    s = np.array([1e-4, -3e-4, 2e-4, 0.5e-4, -1e-4])
+    basis = runpales.p2_basis(vectors/np.linalg.norm(vectors, axis=-1)[..., None])
+    D = np.dot(basis*runpales.dmax(pairs, vectors)[..., None], s)[0]
+    assert np.allclose(runpales.native_rdcs(coords, index, pairs, 'svd', D), D)
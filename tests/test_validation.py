@@ -0,0 +1,34 @@
+"""
+Checks of the fits with held-out observables used by the cross-validation.
+"""
+
+import os
+import numpy as np
+
+from maxent import cs, io, validation
+from maxent.cs import _Gamma, _minimize
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, 'data')
+
+
+def _data():
+    resind, Q = io.load_experimental(os.path.join(DATA, 'experimental.dat'))
+    q = np.asarray(io.load(os.path.join(DATA, 'calculated.npy')))[:, :len(Q)]
+    return q, Q
+
+def test_masked():
+    # Holding out observables is the same as fitting the other columns only
+    q, Q = _data()
+    active = np.ones(len(Q), bool)
+    active[[2, 7, 8, 20]] = False
+    sigma2 = 0.5*np.ones(len(Q))
+    fun = _Gamma(q, Q, sigma2)
+    masked = validation._Masked(fun, active)
+    lam = _minimize(masked, np.zeros(active.sum()), 'trust-exact').x
+    assert np.allclose(lam, cs.fit(q[:, active], Q[active], 0.5, method='trust-exact'), rtol=1e-6, atol=1e-10)
+
+def test_cross_validate_jobs():
+    q, Q = _data()
+    result = validation.cross_validate(q, Q, [0.1, 1.], n_folds=4, seed=0)
+    parallel = validation.cross_validate(q, Q, [0.1, 1.], n_folds=4, seed=0, n_jobs=2)
+    assert np.allclose(result['cv_rmsd'], parallel['cv_rmsd'])